@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import array
+import bisect
+
+from Exception import *
+
+
+class AddressIndex:
+    """Translate between RVAs and file pointers with a sorted interval index over the section headers.
+
+    The index is a snapshot of the section headers it was built from, so it keeps describing the loaded file even
+    after the headers are changed for a new layout.
+    """
+
+    def __init__(self, sh):
+        sections = [(x.VirtualAddress, x.VirtualSize, x.PointerToRawData, x.SizeOfRawData) for x in sh if x.SizeOfRawData]
+
+        self.by_rva = sorted(sections)
+        self.rva_starts = [x[0] for x in self.by_rva]
+
+        self.by_fp = sorted(sections, key=lambda x: x[2])
+        self.fp_starts = [x[2] for x in self.by_fp]
+
+        # the original virtual layout of every section, including those without raw data
+        self.layout = sorted([(x.VirtualAddress, x.VirtualSize, x) for x in sh], key=lambda x: x[0])
+
+        # where each section was loaded from, so that it can still be parsed once its header was moved
+        self.loaded = dict([(x.Name, (x.PointerToRawData, x.SizeOfRawData, x.VirtualAddress, x.VirtualSize)) for x in sh])
+
+    def rva2fp(self, rva):
+        i = bisect.bisect_right(self.rva_starts, rva) - 1
+        if i >= 0:
+            va, vsize, fp, fsize = self.by_rva[i]
+            offset = rva - va
+            # the end of a section is mapped too, so that (rva, size) regions can be translated
+            if offset <= vsize and offset < fsize:
+                return fp + offset
+        raise PEFormatError('RVA 0x%x is not mapped to the file' % rva)
+
+    def fp2rva(self, fp):
+        i = bisect.bisect_right(self.fp_starts, fp) - 1
+        if i >= 0:
+            va, vsize, start, fsize = self.by_fp[i]
+            offset = fp - start
+            if offset < fsize and offset < vsize:
+                return va + offset
+        raise PEFormatError('File pointer 0x%x is not mapped to an RVA' % fp)
+
+    def fp_limit(self, fp):
+        """Return the end of the raw data of the section containing fp, or None if fp is outside of all sections."""
+        i = bisect.bisect_right(self.fp_starts, fp) - 1
+        if i >= 0:
+            start, fsize = self.by_fp[i][2:]
+            if fp < start + fsize:
+                return start + fsize
+        return None
+
+    def rva2fp_array(self, rvas):
+        """Translate a sequence of RVAs in one call, return an array of file pointers."""
+        return self.__translate__(rvas, self.rva_starts, [(x[0], min(x[1] + 1, x[3]), x[2]) for x in self.by_rva], 'RVA')
+
+    def fp2rva_array(self, fps):
+        """Translate a sequence of file pointers in one call, return an array of RVAs."""
+        return self.__translate__(fps, self.fp_starts, [(x[2], min(x[1], x[3]), x[0]) for x in self.by_fp], 'File pointer')
+
+    @staticmethod
+    def __translate__(values, starts, spans, what):
+        result = array.array('L', [0]) * len(values)
+        search = bisect.bisect_right
+        lo, hi, base = -1, -1, 0
+        for n, v in enumerate(values):
+            if not lo <= v < hi:
+                # sorted or clustered input mostly stays within the same section
+                i = search(starts, v) - 1
+                if i < 0 or v >= spans[i][0] + spans[i][1]:
+                    raise PEFormatError('%s 0x%x is not mapped' % (what, v))
+                lo, size, target = spans[i]
+                hi, base = lo + size, target - lo
+            result[n] = v + base
+        return result
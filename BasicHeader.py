@@ -4,21 +4,103 @@ import struct
 import re
 
 
-class HeteHeader:
+regexFieldName = re.compile('^[a-zA-Z ]+')
+
+
+def process_table(table_string, left=True):
+    """Split a table copied from the specification into offsets, sizes, names and descriptions.
+
+    Offsets and sizes written as 'PE32/PE32+' take the left or the right value."""
+
+    offsets, sizes, names, descriptions = [], [], [], []
+    index_by_slash = 0 if left else -1
+
+    lines = table_string.strip().split('\n')
+    for line in lines:
+        if not line.strip():
+            continue
+        offset, size, name, description = line.strip().split('\t')
+        offsets.append(int(offset.split('/')[index_by_slash]))
+        sizes.append(int(size.split('/')[index_by_slash]))
+        names.append(regexFieldName.match(name).group(0).replace(' ', ''))
+        descriptions.append('%s\n%s bytes from %s\n' % (name, size, offset) + description.replace('. ', '.\n'))
+
+    return offsets, sizes, names, descriptions
+
+
+class HeaderSchema:
+    """The compiled layout of (a part of) a header, shared by all headers of the same type.
+
+    Decoding is a single unpack_from of the precompiled struct; the documentation dict is only built by doc().
+    """
+
+    def __init__(self, format_string, offsets, sizes, names, descriptions):
+        assert len(offsets) == len(sizes) == len(names) == len(descriptions)
+        self.format = format_string
+        self.struct = struct.Struct('<' + format_string)
+        self.size = self.struct.size
+        self.offsets = tuple(offsets)
+        self.sizes = tuple(sizes)
+        self.names = tuple(names)
+        self.descriptions = tuple(descriptions)
+        self.__evdoc__ = None
+
+    def doc(self):
+        if self.__evdoc__ is None:
+            evdoc = dict(zip([str(x) for x in self.offsets], self.descriptions))
+            evdoc.update(zip(self.names, self.descriptions))
+            self.__evdoc__ = evdoc
+        return self.__evdoc__
+
+
+schemas = {}
+
+
+def get_schema(format_string, table_string, left=True):
+    """Return the schema of a table, compiling it on first use."""
+    key = (format_string, table_string, left)
+    schema = schemas.get(key)
+    if schema is None:
+        schema = schemas[key] = HeaderSchema(format_string, *process_table(table_string, left))
+    return schema
+
+
+class HeteHeader(object):
     """Represent a header
 
+    Field values live in attributes named after the fields; the raw bytes of a field (<Field>Raw) are sliced from the
+    backing data on demand.
     """
 
+    __slots__ = ('data', 'fp', 'size')
+    schemas = ()
+
     def __init__(self, data, file_pointer):
-        self.format = ''
-        self.size = 0
-        self.fieldNames = []
-        self.__evdoc__ = {}
+        self.data = data
         self.fp = file_pointer
+        self.size = 0
         self.parse(data, file_pointer)
         self.validate()
         return
 
+    @property
+    def format(self):
+        return ''.join([x.format for x in self.schemas])
+
+    @property
+    def fieldNames(self):
+        return [name for x in self.schemas for name in x.names]
+
+    def __getattr__(self, name):
+        if name.endswith('Raw'):
+            field = name[:-3]
+            for schema in self.schemas:
+                if field in schema.names:
+                    i = schema.names.index(field)
+                    start = self.fp + schema.offsets[i]
+                    return self.data[start:start + schema.sizes[i]]
+        raise AttributeError('%s has no attribute %s' % (self.__class__.__name__, name))
+
     def parse(self, data, file_pointer):
         assert False, self.__class__.__name__ + '.parse() must be overridden!.'
 
@@ -34,90 +116,86 @@ class HeteHeader:
 
     def doc(self, what=''):
         """Return the description of a field"""
-        return self.__evdoc__[str(what).lower()]
+        evdoc = {}
+        for schema in self.schemas:
+            evdoc.update(schema.doc())
+        return evdoc[str(what).lower()]
 
     def validate(self):
         """Validation check"""
         return
 
-    def process_table(self, table_string, left=True):
-        offsets, sizes, names, descriptions = [], [], [], []
-        index_by_slash = 0 if left else -1
-        regex = re.compile('^[a-zA-Z ]+')
-
-        lines = table_string.strip().split('\n')
-        for line in lines:
-            if not line.strip():
-                continue
-            offset, size, name, description = line.strip().split('\t')
-            offsets.append(int(offset.split('/')[index_by_slash]))
-            sizes.append(int(size.split('/')[index_by_slash]))
-            names.append(regex.match(name).group(0).replace(' ', ''))
-            descriptions.append('%s\n%s bytes from %s\n' % (name, size, offset) + description.replace('. ', '.\n'))
-
-        return offsets, sizes, names, descriptions
-
-    def set_attributes(self, data, file_pointer, format_string, offsets, sizes, names, descriptions):
-        values = struct.unpack_from('<' + format_string, data, file_pointer + offsets[0])
-        assert len(values) == len(offsets) == len(sizes) == len(names) == len(descriptions)
-        for i in range(len(values)):
-            setattr(self, names[i], values[i])
-            setattr(self, names[i] + 'Raw', data[file_pointer + offsets[i]:file_pointer + offsets[i] + sizes[i]])
-
-        self.format += format_string
-        self.size += struct.calcsize(format_string)
-        self.fieldNames += names
-        newdoc1 = [(str(offsets[i]), descriptions[i]) for i in range(len(offsets))]
-        newdoc2 = [(names[i], descriptions[i]) for i in range(len(offsets))]
-        self.__evdoc__ = dict(self.__evdoc__.items() + newdoc1 + newdoc2)
+    def set_attributes(self, data, file_pointer, schema):
+        values = schema.struct.unpack_from(data, file_pointer + schema.offsets[0])
+        for name, value in zip(schema.names, values):
+            setattr(self, name, value)
+        self.size += schema.size
+        self.schemas += (schema,)
+
+    @classmethod
+    def restore(cls, data, file_pointer, values, schemas):
+        """Rebuild a header from its schemas and the field values of an earlier parse, without decoding data."""
+        self = cls.__new__(cls)
+        self.data, self.fp, self.size = data, file_pointer, 0
+        for schema in schemas:
+            for name, value in zip(schema.names, values):
+                setattr(self, name, value)
+            values = values[len(schema.names):]
+            self.size += schema.size
+        self.schemas = tuple(schemas)
+        return self
+
+    def get_values(self):
+        return tuple([getattr(self, x) for x in self.fieldNames])
 
     def set_attributes_by_table(self, data, file_pointer, format_string, table_string):
-        info = self.process_table(table_string)
-        self.set_attributes(data, file_pointer, format_string, *info)
+        self.set_attributes(data, file_pointer, get_schema(format_string, table_string))
 
     def write(self):
         return struct.pack(self.format, *[getattr(self, x) for x in self.fieldNames])
 
+    def write_into(self, buf, offset):
+        """Serialize into a preallocated buffer at offset, return the offset right after the header."""
+        struct.pack_into('<' + self.format, buf, offset, *[getattr(self, x) for x in self.fieldNames])
+        return offset + self.size
+
 
 class HomoHeader(HeteHeader):
-    def process_table(self, table_string, left=True):
-
-        if not hasattr(self.__class__, 'info'):
-            offsets, sizes, names, descriptions = [], [], [], []
-            index_by_slash = 0 if left else -1
-            regex = re.compile('^[a-zA-Z ]+')
-
-            lines = table_string.strip().split('\n')
-            for line in lines:
-                if not line.strip():
-                    continue
-                offset, size, name, description = line.strip().split('\t')
-                offsets.append(int(offset.split('/')[index_by_slash]))
-                sizes.append(int(size.split('/')[index_by_slash]))
-                names.append(regex.match(name).group(0).replace(' ', ''))
-                descriptions.append('%s\n%s bytes from %s\n' % (name, size, offset) + description.replace('. ', '.\n'))
-
-            self.__class__.info = offsets, sizes, names, descriptions
-        return self.__class__.info
-
-    def set_attributes(self, data, file_pointer, format_string, offsets, sizes, names, descriptions):
-        values = struct.unpack_from('<' + format_string, data, file_pointer + offsets[0])
-        assert len(values) == len(offsets) == len(sizes) == len(names) == len(descriptions)
-        for i in range(len(values)):
-            setattr(self, names[i], values[i])
-            setattr(self, names[i] + 'Raw', data[file_pointer + offsets[i]:file_pointer + offsets[i] + sizes[i]])
-        self.size = struct.calcsize(format_string)
-
-        if not hasattr(self.__class__, 'format'):
-            self.__class__.format = format_string
-            self.__class__.fieldNames = names
-            newdoc1 = [(str(offsets[i]), descriptions[i]) for i in range(len(offsets))]
-            newdoc2 = [(names[i], descriptions[i]) for i in range(len(offsets))]
-            self.__class__.__evdoc__ = dict(self.__evdoc__.items() + newdoc1 + newdoc2)
-
-        self.format = self.__class__.format
-        self.fieldNames = self.__class__.fieldNames
-        self.__evdoc__ = self.__class__.__evdoc__
+    """A header made of a single schema, of which there are usually many instances.
+
+    Subclasses list the schema's field names in __slots__, so an instance holds nothing but its field values.
+    """
+
+    __slots__ = ()
+    schema = None
+
+    @property
+    def schemas(self):
+        return self.schema,
+
+    @property
+    def format(self):
+        return self.schema.format
+
+    @property
+    def fieldNames(self):
+        return self.schema.names
+
+    @classmethod
+    def restore(cls, data, file_pointer, values, schemas=None):
+        self = cls.__new__(cls)
+        self.data, self.fp, self.size = data, file_pointer, cls.schema.size
+        for name, value in zip(cls.schema.names, values):
+            setattr(self, name, value)
+        return self
+
+    def set_attributes(self, data, file_pointer, schema):
+        values = schema.struct.unpack_from(data, file_pointer + schema.offsets[0])
+        for name, value in zip(schema.names, values):
+            setattr(self, name, value)
+        self.size = schema.size
+        if self.__class__.schema is None:
+            self.__class__.schema = schema
 
 
 class BasicHeader:
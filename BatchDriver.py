@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import json
+import time
+import struct
+import logging
+import traceback
+import multiprocessing
+
+from Exception import *
+
+import Events
+import ParseCache
+import PE
+
+
+logger = logging.getLogger('VirusEvasion.BatchDriver')
+
+# Errors that mean "this file is not a PE we can handle", as opposed to a bug in the pipeline.
+MALFORMED_ERRORS = (AssertionError, VEException, struct.error)
+
+# the parse cache of this worker process, see init_worker()
+parse_cache = None
+
+
+def iter_files(paths):
+    """Yield every regular file under the given files and directories."""
+    for path in paths:
+        if os.path.isfile(path):
+            yield path, os.path.basename(path)
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                filename = os.path.join(root, name)
+                if os.path.isfile(filename):
+                    yield filename, os.path.relpath(filename, path)
+
+
+def process_file(job):
+    """Run the parse/rewrite pipeline over one file and return its manifest record.
+
+    Never raises, so that one bad sample cannot kill the pool worker processing it."""
+
+    filename, output = job
+    result = {'file': filename, 'output': output, 'status': 'ok', 'error': None, 'size': 0, 'new_size': 0}
+    start = time.time()
+    pe = None
+    try:
+        pe = PE.PE(filename, cache=parse_cache)
+        result['size'] = pe.size
+        pe.calculate_new_size()
+        pe.calculate_new_address()
+        pe.relocate()
+        if output is None:
+            output = os.devnull
+        else:
+            directory = os.path.dirname(output)
+            if directory and not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    if not os.path.isdir(directory):  # another worker may have created it
+                        raise
+        result['new_size'] = pe.write(output)
+    except MALFORMED_ERRORS, e:
+        result['status'] = 'malformed'
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        logger.warning('skipping malformed file %s (%s)', filename, result['error'])
+    except Exception, e:
+        result['status'] = 'error'
+        result['error'] = '%s: %s' % (e.__class__.__name__, e)
+        logger.error('failed to process %s\n%s', filename, traceback.format_exc())
+    finally:
+        if pe is not None:
+            pe.close()
+    result['seconds'] = time.time() - start
+    return result
+
+
+def init_worker(verbose, cache_dir=None, cache_size=None):
+    global parse_cache
+    Events.set_verbose(verbose)
+    if cache_dir is not None:
+        parse_cache = ParseCache.ParseCache(cache_dir, cache_size) if cache_size else ParseCache.ParseCache(cache_dir)
+
+
+def run(paths, output_dir=None, manifest=None, workers=None, chunk_size=16, verbose=False, cache_dir=None,
+        cache_size=None):
+    """Push every file under paths through the pipeline with a process pool.
+
+    One JSON record per file is written to manifest (a filename or a file object) as soon as it is done.
+    Workers are silent unless verbose is set, and share the parse cache in cache_dir if given.
+    Returns a dict with the number of files per status."""
+
+    jobs = [(f, os.path.join(output_dir, rel) if output_dir else None) for f, rel in iter_files(paths)]
+    workers = workers or multiprocessing.cpu_count()
+
+    if manifest is None:
+        out = None
+    elif hasattr(manifest, 'write'):
+        out = manifest
+    else:
+        out = open(manifest, 'w')
+
+    stats = {'ok': 0, 'malformed': 0, 'error': 0}
+    pool = multiprocessing.Pool(processes=workers, initializer=init_worker,
+                                initargs=(verbose, cache_dir, cache_size))
+    try:
+        for result in pool.imap_unordered(process_file, jobs, chunk_size):
+            stats[result['status']] += 1
+            if out is not None:
+                out.write(json.dumps(result, sort_keys=True) + '\n')
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        if out is not None and out is not manifest:
+            out.close()
+
+    logger.info('%d files: %d ok, %d malformed, %d error', len(jobs), stats['ok'], stats['malformed'], stats['error'])
+    return stats
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the PE parse/rewrite pipeline over files and directories.')
+    parser.add_argument('paths', nargs='+', help='files or directories to process')
+    parser.add_argument('-o', '--output-dir', help='where to write the rewritten images (default: discard)')
+    parser.add_argument('-m', '--manifest', help='per-file result manifest, one JSON record per line')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes (default: cpu count)')
+    parser.add_argument('-c', '--chunk-size', type=int, default=16, help='files handed to a worker at a time')
+    parser.add_argument('-v', '--verbose', action='store_true', help='print the progress of every file')
+    parser.add_argument('--cache-dir', help='reuse parse results kept in this directory across runs')
+    parser.add_argument('--cache-size', type=int, default=None, help='size cap of the parse cache in MB')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+    cache_size = args.cache_size * 1024 * 1024 if args.cache_size else None
+    stats = run(args.paths, args.output_dir, args.manifest, args.workers, args.chunk_size, args.verbose,
+                args.cache_dir, cache_size)
+    return 0 if stats['error'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+import gc
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+import BatchDriver
+import Events
+import PE
+import SectionReloc
+
+
+def stage_parse_headers(filename, pe):
+    return PE.PE(filename, lazy=True)
+
+
+def stage_parse_sections(filename, pe):
+    for name in pe.sections.keys():
+        pe.sections[name]
+    return pe
+
+
+def stage_parse_iat_ilt(filename, pe):
+    idata = pe.get_handled_section('SectionIdata')
+    if idata is not None:
+        idata.idt = []
+        idata.parse(pe.oh)
+    return pe
+
+
+def stage_parse_brt(filename, pe):
+    old = pe.get_reloc()
+    if old is not None:
+        reloc = SectionReloc.SectionReloc(pe.data, old.fp, old.fsize, old.rva, old.vsize)
+        reloc.parse(pe.oh)
+    return pe
+
+
+def stage_decode_text(filename, pe):
+    text = pe.get_handled_section('SectionText')
+    if text is not None:
+        text.get_instructions()
+    return pe
+
+
+def stage_imports(filename, pe):
+    pe.imports = None
+    pe.get_imports()
+    return pe
+
+
+def stage_check_regions(filename, pe):
+    pe.check_regions()
+    return pe
+
+
+def stage_relayout(filename, pe):
+    pe.calculate_new_size()
+    pe.calculate_new_address()
+    pe.relocate()
+    return pe
+
+
+def stage_write(filename, pe):
+    fd, output = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        pe.write(output)
+    finally:
+        os.remove(output)
+    return pe
+
+
+# each stage gets the PE left by the previous one
+STAGES = [
+    ('parse_headers', stage_parse_headers),
+    ('parse_sections', stage_parse_sections),
+    ('parse_iat_ilt', stage_parse_iat_ilt),
+    ('parse_brt', stage_parse_brt),
+    ('decode_text', stage_decode_text),
+    ('imports', stage_imports),
+    ('check_regions', stage_check_regions),
+    ('relayout', stage_relayout),
+    ('write', stage_write),
+]
+
+
+def peak_memory_kb():
+    """Return the peak RSS of the process so far, in KB."""
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_file(filename, stages, seconds):
+    """Run the stages over one file, adding the time of each to seconds; return False if the file is malformed.
+
+    Nothing is added for a malformed file, whichever stage it fails in."""
+    pe = None
+    times = []
+    try:
+        for name, func in stages:
+            start = time.time()
+            pe = func(filename, pe)
+            times.append((name, time.time() - start))
+    except BatchDriver.MALFORMED_ERRORS:
+        return False
+    finally:
+        if pe is not None:
+            pe.close()
+    for name, t in times:
+        seconds[name] = seconds.get(name, 0) + t
+    return True
+
+
+def run(paths, repeat=3, stages=None):
+    """Time the stages over the corpus, return the results as a dict.
+
+    The stages a selected stage depends on are run too, but not reported. Each stage keeps the best of repeat
+    rounds. Peak memory is the peak RSS of the process over the whole run (tracemalloc does not exist on Python 2),
+    it cannot be told apart by stage."""
+
+    selected = [x[0] for x in STAGES if stages is None or x[0] in stages]
+    last = max([i for i, x in enumerate(STAGES) if x[0] in selected] or [-1])
+    files = [x[0] for x in BatchDriver.iter_files(paths)]
+    verbose = Events.verbose
+    Events.set_verbose(False)
+
+    try:
+        best, good = {}, []
+        for i in xrange(repeat):
+            seconds = {}
+            gc.collect()
+            good = [x for x in files if run_file(x, STAGES[:last + 1], seconds)]
+            for name in seconds:
+                best[name] = min(best.get(name, seconds[name]), seconds[name])
+    finally:
+        Events.set_verbose(verbose)
+
+    size = sum([os.path.getsize(x) for x in good])
+    results = {
+        'python': platform.python_version(),
+        'files': len(good),
+        'skipped': len(files) - len(good),
+        'bytes': size,
+        'peak_rss_kb': peak_memory_kb(),
+        'stages': {},
+    }
+    for name in selected:
+        seconds = best.get(name, 0.0)
+        results['stages'][name] = {
+            'seconds': seconds,
+            'files_per_s': len(good) / seconds if seconds else None,
+            'mb_per_s': size / 1048576.0 / seconds if seconds else None,
+        }
+    return results
+
+
+def compare(results, baseline, tolerance=0.1):
+    """Return (stage, old MB/s, new MB/s) for every stage more than tolerance slower than in the baseline."""
+    regressions = []
+    for name, new in sorted(results['stages'].items()):
+        old = baseline['stages'].get(name)
+        if not old or not old['mb_per_s'] or not new['mb_per_s']:
+            continue
+        if new['mb_per_s'] < old['mb_per_s'] * (1 - tolerance):
+            regressions.append((name, old['mb_per_s'], new['mb_per_s']))
+    return regressions
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Time the parse, re-layout and write stages over a corpus.')
+    parser.add_argument('paths', nargs='+', help='files or directories of the corpus')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='rounds per stage, the best one is kept')
+    parser.add_argument('-s', '--stage', action='append', help='only run these stages (repeatable)')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('-b', '--baseline', help='compare with results saved earlier')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.1, help='allowed slowdown against the baseline')
+    args = parser.parse_args(argv)
+
+    results = run(args.paths, args.repeat, args.stage)
+
+    print '%d files, %.1f MB (%d skipped), peak RSS %d KB' % (results['files'], results['bytes'] / 1048576.0,
+                                                               results['skipped'], results['peak_rss_kb'])
+    print '%-16s %10s %10s %10s' % ('stage', 'seconds', 'files/s', 'MB/s')
+    for name, func in STAGES:
+        if name in results['stages']:
+            r = results['stages'][name]
+            print '%-16s %10.4f %10.1f %10.2f' % (name, r['seconds'], r['files_per_s'] or 0, r['mb_per_s'] or 0)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for name, old, new in regressions:
+            print 'REGRESSION %s: %.2f MB/s -> %.2f MB/s' % (name, old, new)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import array
+import sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_word_sum(data, start=0, end=None):
+    """Return the sum of the little-endian 16-bit words of data[start:end], modulo 0xffff.
+
+    The words line up with the image: a range starting at an odd offset begins with the high byte of a word, and an
+    odd last byte is the low byte of a word of its own. Each chunk is summed as an array of words, by NumPy where it
+    is available."""
+    end = len(data) if end is None else min(end, len(data))
+    total = 0
+    if start < end and start % 2:
+        total, start = ord(str(data[start:start + 1])) << 8, start + 1
+    for offset in xrange(start, end, CHUNK_SIZE):
+        chunk = data[offset:min(offset + CHUNK_SIZE, end)]
+        if len(chunk) % 2:
+            chunk = str(chunk) + '\x00'
+        if numpy is not None:
+            total += int(numpy.frombuffer(chunk, '<u2').sum(dtype=numpy.uint64))
+        else:
+            words = array.array('H', str(chunk))
+            if sys.byteorder == 'big':
+                words.byteswap()
+            total += sum(words)
+    return total % 0xffff
+
+
+def get_word_sum_outside(data, ranges, checksum_fp):
+    """Return the word sum of data but the sorted, disjoint (start, end) ranges and the CheckSum field at checksum_fp."""
+    total, fp = 0, 0
+    for start, end in sorted(ranges + [(checksum_fp, checksum_fp + 4)]):
+        total += get_word_sum(data, fp, start)
+        fp = max(fp, end)
+    return (total + get_word_sum(data, fp)) % 0xffff
+
+
+def get_stored_word_sum(checksum, size):
+    """Return the word sum a file of size bytes has if checksum, its CheckSum field, is right; None if it cannot be."""
+    word_sum = checksum - size
+    return word_sum % 0xffff if 0 < word_sum <= 0xffff else None
+
+
+def get_checksum(word_sum, size):
+    """Return the image checksum of a file of size bytes, whose words (but the CheckSum field) add up to word_sum.
+
+    The checksum is their sum folded into 16 bits with end-around carry, plus the size of the file. Folding never
+    gives 0 once a word is not 0, which is always the case for an image (it starts with 'MZ'), so a sum congruent to
+    0 is 0xffff."""
+    return int((word_sum % 0xffff or 0xffff) + size) & 0xffffffff
+
+
+def compute(data, checksum_fp):
+    """Return the image checksum of data, with the CheckSum field at checksum_fp."""
+    return get_checksum(get_word_sum(data, 0, checksum_fp) + get_word_sum(data, checksum_fp + 4), len(data))
+
+
+if __name__ == '__main__':
+    import PE
+
+    pe = PE.PE('helloworld.exe')
+    print 'CheckSum 0x%08x, computed 0x%08x' % (pe.oh.CheckSum, pe.get_checksum())
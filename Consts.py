@@ -1,3 +1,30 @@
 # -*- coding: utf-8 -*-
 FILE_OFFSET_TO_PE_SIGNATURE = 0x3c
-PE32_MAGIC_NUMBER = 0x10b
\ No newline at end of file
+PE32_MAGIC_NUMBER = 0x10b
+OPTIONAL_HEADER_OFFSET_TO_CHECKSUM = 64
+IMAGE_FILE_RELOCS_STRIPPED = 0x0001
+IMAGE_REL_BASED_ABSOLUTE = 0
+IMAGE_REL_BASED_HIGHLOW = 3
+
+# resource types
+RT_CURSOR = 1
+RT_BITMAP = 2
+RT_ICON = 3
+RT_MENU = 4
+RT_DIALOG = 5
+RT_STRING = 6
+RT_FONTDIR = 7
+RT_FONT = 8
+RT_ACCELERATOR = 9
+RT_RCDATA = 10
+RT_MESSAGETABLE = 11
+RT_GROUP_CURSOR = 12
+RT_GROUP_ICON = 14
+RT_VERSION = 16
+RT_DLGINCLUDE = 17
+RT_PLUGPLAY = 19
+RT_VXD = 20
+RT_ANICURSOR = 21
+RT_ANIICON = 22
+RT_HTML = 23
+RT_MANIFEST = 24
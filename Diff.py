@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import bisect
+
+import RegionMap
+
+
+CHUNK_SIZE = 1024 * 1024
+SCAN_SIZE = 64
+
+
+def get_ranges(a, b):
+    """Return (start, end) of every run of bytes which differ between a and b, sorted and merged.
+
+    Chunks are compared as a whole, which is a memcmp; a differing chunk is halved until the differing parts are
+    SCAN_SIZE bytes or less, which are compared byte by byte. Whatever follows the end of the shorter image differs."""
+    common = min(len(a), len(b))
+    ranges = []
+    for offset in xrange(0, common, CHUNK_SIZE):
+        end = min(offset + CHUNK_SIZE, common)
+        if a[offset:end] == b[offset:end]:
+            continue
+
+        pending = [(offset, end)]
+        while pending:
+            start, end = pending.pop()
+            if end - start > SCAN_SIZE:
+                middle = (start + end) // 2
+                # the upper half first, so that ranges are found in order
+                for lo, hi in ((middle, end), (start, middle)):
+                    if a[lo:hi] != b[lo:hi]:
+                        pending.append((lo, hi))
+                continue
+
+            x, y = str(a[start:end]), str(b[start:end])
+            for i in xrange(end - start):
+                if x[i] != y[i]:
+                    add_range(ranges, start + i, start + i + 1)
+
+    if len(a) != len(b):
+        add_range(ranges, common, max(len(a), len(b)))
+    return ranges
+
+
+def add_range(ranges, start, end):
+    if ranges and ranges[-1][1] == start:
+        ranges[-1] = (ranges[-1][0], end)
+    else:
+        ranges.append((start, end))
+
+
+def get_field_regions(pe):
+    """Return (start, end, name) of every field of the headers of pe, named after their header."""
+    regions = []
+    headers = [('COFF File Header', pe.cfh), ('Optional Header', pe.oh)]
+    headers += [('Section Header (%s)' % sh.Name, sh) for sh in pe.sh]
+    for header_name, header in headers:
+        for schema in header.schemas:
+            for offset, size, name in zip(schema.offsets, schema.sizes, schema.names):
+                regions.append((header.fp + offset, header.fp + offset + size, '%s.%s' % (header_name, name)))
+    return regions
+
+
+class Change:
+    """A run of bytes which differ between two images, and the regions of the first one it falls in."""
+
+    def __init__(self, start, end, owners):
+        self.start = start
+        self.end = end
+        self.owners = owners
+
+    def __str__(self):
+        return '%5x~%5x (%5d bytes)  %s' % (self.start, self.end, self.end - self.start, ', '.join(self.owners))
+
+
+def diff(a, b, pe=None):
+    """Return the Changes between the images a and b, with their owners taken from the regions of pe, the PE a is
+    the image of: header fields, headers, sections, import tables and relocation blocks, outermost first."""
+    ranges = get_ranges(a, b)
+    if pe is None:
+        return [Change(start, end, []) for start, end in ranges]
+
+    regions, unmapped = pe.get_all_regions()
+    region_map = RegionMap.RegionMap(regions + get_field_regions(pe), max(len(a), len(b)))
+    changes = []
+    for start, end in ranges:
+        owners = []
+        # every segment the range runs over
+        i = max(bisect.bisect_right(region_map.bounds, start) - 1, 0)
+        while i < len(region_map.covers) and region_map.bounds[i] < end:
+            for r in region_map.covers[i]:
+                if r[2] not in owners:
+                    owners.append(r[2])
+            i += 1
+        changes.append(Change(start, end, owners))
+    return changes
+
+
+if __name__ == '__main__':
+    import PE
+
+    pe = PE.PE('helloworld.exe')
+    pe.calculate_new_size()
+    pe.calculate_new_address()
+    pe.relocate()
+    for change in diff(pe.data, pe.build(), pe):
+        print change
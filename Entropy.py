@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import math
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+CHUNK_SIZE = 1024 * 1024
+
+BYTES = [chr(i) for i in xrange(256)]
+
+# deletechars keeping only the 16 byte values starting at each multiple of 16, for the pure Python histogram
+KEEP = [''.join(BYTES[:lo] + BYTES[lo + 16:]) for lo in xrange(0, 256, 16)]
+
+
+def get_histogram(data, start=0, end=None):
+    """Return the number of occurrences of each byte value in data[start:end], as a list of 256 counts.
+
+    With NumPy it is a bincount over a view of data. Without it, each chunk is split into 16 strings by the high
+    nibble of its bytes (str.translate deleting the 240 other values) and the bytes of each string are counted by
+    str.count, which makes 16 + 16 passes in C instead of one Python operation per byte."""
+    end = len(data) if end is None else min(end, len(data))
+    if start >= end:
+        return [0] * 256
+    if numpy is not None:
+        return numpy.bincount(numpy.frombuffer(data, numpy.uint8, end - start, start), minlength=256).tolist()
+
+    counts = [0] * 256
+    for offset in xrange(start, end, CHUNK_SIZE):
+        chunk = str(data[offset:min(offset + CHUNK_SIZE, end)])
+        for i, lo in enumerate(xrange(0, 256, 16)):
+            part = chunk.translate(None, KEEP[i])
+            if part:
+                counts[lo:lo + 16] = [x + y for x, y in zip(counts[lo:lo + 16], map(part.count, BYTES[lo:lo + 16]))]
+    return counts
+
+
+def get_entropy(histogram):
+    """Return the Shannon entropy of a byte histogram, in bits per byte (0 to 8)."""
+    total = float(sum(histogram))
+    if not total:
+        return 0.0
+    return -sum([x / total * math.log(x / total, 2) for x in histogram if x])
+
+
+def get_profile(data, start=0, end=None, window=4096, step=None):
+    """Return [(offset, entropy)] of the windows of window bytes of data[start:end], step bytes apart (window by
+    default). The last window may be shorter."""
+    end = len(data) if end is None else min(end, len(data))
+    step = step or window
+    return [(offset, get_entropy(get_histogram(data, offset, min(offset + window, end))))
+            for offset in xrange(start, end, step)]
+
+
+class ByteStats:
+    """The byte histogram and the entropy of a part of a file, with its entropy profile if one was asked for."""
+
+    def __init__(self, name, data, fp, size, window=None, step=None):
+        self.name = name
+        self.fp = fp
+        self.size = size
+        self.histogram = get_histogram(data, fp, fp + size)
+        self.entropy = get_entropy(self.histogram)
+        self.profile = get_profile(data, fp, fp + size, window, step) if window else None
+
+    def __str__(self):
+        s = '%-10s %10d bytes from 0x%08x, entropy %.3f' % (self.name, self.size, self.fp, self.entropy)
+        if self.profile:
+            s += ' [%s]' % ' '.join(['%.1f' % x for offset, x in self.profile])
+        return s
+
+
+def analyze(pe, window=None, step=None):
+    """Return the ByteStats of the headers, of the raw data of each section and of the overlay of a PE.
+
+    The headers are the first SizeOfHeaders bytes, the overlay is what follows the end of the last section."""
+    size = len(pe.data)
+    headers_size = min(pe.oh.SizeOfHeaders, size)
+    stats = [ByteStats('Headers', pe.data, 0, headers_size, window, step)]
+
+    end = headers_size
+    for sh in pe.sh:
+        if sh.PointerToRawData == 0 or sh.PointerToRawData >= size:
+            continue
+        raw_size = min(sh.SizeOfRawData, size - sh.PointerToRawData)
+        stats.append(ByteStats(sh.Name, pe.data, sh.PointerToRawData, raw_size, window, step))
+        end = max(end, sh.PointerToRawData + raw_size)
+
+    if end < size:
+        stats.append(ByteStats('Overlay', pe.data, end, size - end, window, step))
+    return stats
+
+
+if __name__ == '__main__':
+    import PE
+
+    pe = PE.PE('helloworld.exe')
+    for x in analyze(pe, window=0x1000):
+        print x
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""Progress reporting for the parse/rewrite pipeline.
+
+Every step is reported with emit(stage, event, message, *args, **fields). The message is printed when verbose is
+set, and every subscribed listener gets a dict with the stage, the event and the fields (section, fp, rva, size...).
+Callers test `active` first, so that nothing is formatted or built at all when nobody is listening:
+
+    if Events.active:
+        Events.emit('parse', 'coff_header', 'Parsing COFF File Header from 0x%x', fp, fp=fp)
+"""
+
+listeners = []
+verbose = True
+active = True
+
+
+def __update__():
+    global active
+    active = verbose or bool(listeners)
+
+
+def set_verbose(flag):
+    """Turn the progress lines on stdout on or off."""
+    global verbose
+    verbose = flag
+    __update__()
+
+
+def subscribe(listener):
+    """Call listener(record) for every event from now on."""
+    listeners.append(listener)
+    __update__()
+
+
+def unsubscribe(listener):
+    listeners.remove(listener)
+    __update__()
+
+
+def emit(stage, event, message, *args, **fields):
+    if verbose:
+        print message % args if args else message
+    if listeners:
+        fields['stage'] = stage
+        fields['event'] = event
+        for listener in listeners:
+            listener(fields)
+
+
+class Collector:
+    """A listener which keeps every record, optionally only those of some stages."""
+
+    def __init__(self, stages=None):
+        self.stages = stages
+        self.records = []
+
+    def __call__(self, record):
+        if self.stages is None or record['stage'] in self.stages:
+            self.records.append(record)
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import array
+import bisect
+import struct
+
+from Exception import *
+from Consts import *
+
+import Events
+import SectionIdata
+import SectionRegistry
+
+
+class Fixup:
+    """Move sections to new RVAs by fixing up every absolute pointer listed in the base relocation table.
+
+    The old layout comes from the PE's address index and the new one from its section headers. Each section gets a
+    delta (new RVA - old RVA); a pointer is moved by the delta of the section it points into, and the locations in the
+    .reloc section are moved by the delta of the section they are in. All pointers of a section are read and written
+    back with a single struct call over the section contents. Without a base relocation table, the pointers cannot be
+    found, and sections cannot move.
+    """
+
+    def __init__(self, pe):
+        self.pe = pe
+        self.starts = [x[0] for x in pe.index.layout]
+        self.deltas = [x[2].VirtualAddress - x[0] for x in pe.index.layout]
+        # the end of the image in memory: the last section takes up its whole alignment tail
+        end, alignment = max([x[0] + x[1] for x in pe.index.layout]), pe.oh.SectionAlignment
+        self.end = end + (alignment - end % alignment) % alignment
+
+    def moved(self):
+        return any(self.deltas)
+
+    def move_rva(self, rva):
+        """Return where an RVA of the old layout is in the new one. Addresses in the headers do not move."""
+        if rva > self.end:
+            return rva
+        i = bisect.bisect_right(self.starts, rva) - 1
+        return rva + self.deltas[i] if i >= 0 else rva
+
+    def apply(self):
+        if not self.moved():
+            return 0
+
+        reloc = self.pe.get_reloc()
+        if self.pe.cfh.Characteristics & IMAGE_FILE_RELOCS_STRIPPED:
+            raise PEFormatError('Sections cannot move: the base relocations have been stripped')
+        if reloc is None:
+            raise PEFormatError('Sections cannot move: there is no base relocation section to find the pointers by')
+
+        count = 0
+        rvas, types = reloc.get_locations()
+        if any([x != IMAGE_REL_BASED_HIGHLOW for x in types]):
+            raise PEFormatError('Only IMAGE_REL_BASED_HIGHLOW base relocations can be fixed up')
+        rvas = sorted(rvas)
+        count += self.fix_locations(rvas, self.pe.oh.ImageBase)
+        reloc.set_locations(array.array('I', [self.move_rva(x) for x in rvas]))
+        self.resize_reloc(reloc)
+
+        count += self.fix_exports()
+        count += self.fix_imports()
+        self.fix_optional_header()
+
+        if Events.active:
+            Events.emit('relocate', 'fixup', 'Fixed up %d pointers', count, count=count)
+        return count
+
+    def resize_reloc(self, reloc):
+        """Size the rebuilt relocation table again. PE.calculate_new_size() sized the parsed one, which may have been
+        split into other blocks or padded otherwise. The sections after it move in the file, but must not move in
+        memory: their pointers have been fixed up already."""
+        pe = self.pe
+        reloc.calculate_new_size(pe.oh.FileAlignment, pe.oh.SectionAlignment)
+        pe.oh.BaseRelocationTableSize = reloc.new_size
+
+        position = [x.Name for x in pe.sh].index(reloc.name)
+        sh = pe.sh[position]
+        if (sh.SizeOfRawData, sh.VirtualSize) == (reloc.new_fsize, reloc.new_vsize):
+            return
+        sh.SizeOfRawData, sh.VirtualSize = reloc.new_fsize, reloc.new_vsize
+        rvas = [x.VirtualAddress for x in pe.sh[position + 1:]]
+        pe.calculate_new_address(position + 1)
+        if rvas != [x.VirtualAddress for x in pe.sh[position + 1:]]:
+            raise PEFormatError('The rebuilt base relocation table (0x%x bytes) runs into the section after %s' % (
+                reloc.new_size, sh.Name))
+
+    def fix_locations(self, rvas, base):
+        """Move the pointers at the sorted rvas, which hold an RVA plus base, return how many were moved."""
+        count = 0
+        for va, vsize, sh in self.pe.index.layout:
+            first, last = bisect.bisect_left(rvas, va), bisect.bisect_left(rvas, va + vsize)
+            if first == last:
+                continue
+            if sh.Name not in self.pe.sections:
+                raise PEFormatError('Section %s has pointers to fix up but no raw data' % sh.Name)
+            count += self.fix_section(self.pe.sections[sh.Name], [x - va for x in rvas[first:last]], base)
+        return count
+
+    def fix_exports(self):
+        """Move the RVAs of the export tables: in the export directory, the export address table and the name pointer
+        table. The export index is built from the old layout, before the optional header is fixed up."""
+        exports = self.pe.get_exports()
+        d = exports.directory
+        if d is None:
+            return 0
+
+        rva = self.pe.oh.ExportTableRVA
+        rvas = [rva + 12, rva + 28, rva + 32, rva + 36]
+        rvas += [d.ExportAddressTableRVA + 4 * i for i, x in enumerate(exports.addresses) if x]
+        rvas += [d.NamePointerRVA + 4 * i for i in xrange(len(exports.name_rvas))]
+        return self.fix_locations(sorted(rvas), 0)
+
+    def fix_imports(self):
+        """Move the RVAs of the import tables: the ILT, name and IAT RVAs of the import directory, and the hint/name
+        RVAs of the lookup and address tables. Ordinals and terminators are left as they are, and so is the IAT of a
+        bound DLL, which holds addresses. SectionIdata rewrites the import tables of its section itself."""
+        pe = self.pe
+        rva = pe.oh.ImportTableRVA
+        if rva == 0:
+            return 0
+        i = bisect.bisect_right(self.starts, rva) - 1
+        if i >= 0 and pe.handlers.get(pe.index.layout[i][2].Name) is SectionRegistry.get_class('SectionIdata'):
+            return 0
+
+        rvas = []
+        for n, idt in enumerate(SectionIdata.get_idt(pe.data, pe.rva2fp(rva))):
+            entry = rva + n * idt.size
+            rvas += [entry + 12]
+            tables = [idt.ImportLookupTableRVA, idt.ImportAddressTableRVA if idt.Time == 0 else 0]
+            for offset, table in zip([0, 16], tables):
+                if not table:
+                    continue
+                rvas.append(entry + offset)
+                fp = pe.rva2fp(table)
+                words = array.array('I', pe.data[fp:SectionIdata.find_table_end(pe.data, fp, pe.index.fp_limit(fp))])
+                rvas += [table + 4 * k for k, x in enumerate(words) if not x >> 31]
+        return self.fix_locations(sorted(rvas), 0)
+
+    def fix_section(self, s, offsets, base):
+        """Move every pointer found at offsets (from the start of the section), return how many were moved."""
+        attr = get_contents(s)
+        contents = getattr(s, attr)
+        offsets = [x for x in offsets if x + 4 <= len(contents)]  # the rest is in zero-filled memory
+        if not offsets:
+            return 0
+
+        # one format describing the whole section: the bytes between pointers as strings, the pointers as integers
+        fmt, ending = ['<'], 0
+        for offset in offsets:
+            if offset < ending:
+                raise PEFormatError('Overlapping pointers at 0x%x in %s' % (offset, s.__class__.__name__))
+            fmt.append('%dsI' % (offset - ending))
+            ending = offset + 4
+        fmt.append('%ds' % (len(contents) - ending))
+        fmt = struct.Struct(''.join(fmt))
+
+        values = list(fmt.unpack(contents))
+        move_rva = self.move_rva
+        values[1::2] = [(move_rva(x - base) + base) & 0xffffffff for x in values[1::2]]
+        fmt.pack_into(materialize(s), 0, *values)
+        return len(offsets)
+
+    def fix_optional_header(self):
+        oh = self.pe.oh
+        for name in ['AddressOfEntryPoint', 'BaseOfCode', 'BaseOfData'] + list(oh.schemas[-1].names[::2]):
+            # the certificate table is located by a file pointer
+            if name != 'CertificateTableRVA' and getattr(oh, name):
+                setattr(oh, name, self.move_rva(getattr(oh, name)))
+
+
+def get_contents(s):
+    """Return the name of the attribute which holds the raw contents of a passthrough section."""
+    for attr in ['insts', 'items']:
+        if isinstance(getattr(s, attr, None), (str, buffer, bytearray)):
+            return attr
+    raise PEFormatError('%s cannot be fixed up' % s.__class__.__name__)
+
+
+def materialize(s):
+    """Return the contents of a passthrough section as a bytearray to be changed in place, and mark it dirty.
+
+    Passthrough sections hold a read-only view over the image until then; it is copied on the first call only."""
+    attr = get_contents(s)
+    contents = getattr(s, attr)
+    if not isinstance(contents, bytearray):
+        contents = bytearray(contents)
+        setattr(s, attr, contents)
+    s.dirty = True
+    return contents
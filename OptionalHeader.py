@@ -63,6 +63,21 @@ tableString4 = '''
 216/232	8	Reserved	Reserved, must be zero
 '''
 # format4 = '16Q'  # should be generated according to NumberOfRvaAndSizes
+dataDirectorySchemas = {}
+
+
+def get_data_directory_schema(offset, n):
+    """Return the schema of n data directories starting at offset, compiling it on first use."""
+    key = (offset, n)
+    if key not in dataDirectorySchemas:
+        info = BasicHeader.process_table(tableString4, True)
+        offsets, names, descriptions = xrange(offset, offset + n * 8, 4), [], []
+        for i in xrange(n):
+            names += [info[2][i] + 'RVA', info[2][i] + 'Size']
+            descriptions += [info[3][i].replace('address and size.', 'RVA.'),
+                             info[3][i].replace('address and size.', 'size.')]
+        dataDirectorySchemas[key] = BasicHeader.HeaderSchema('%dI' % (n * 2), offsets, [4] * 2 * n, names, descriptions)
+    return dataDirectorySchemas[key]
 
 
 class OptionalHeader(BasicHeader.HeteHeader):
@@ -81,15 +96,7 @@ class OptionalHeader(BasicHeader.HeteHeader):
         self.set_attributes_by_table(data, file_pointer, format2, tableString2)
         self.set_attributes_by_table(data, file_pointer, format3, tableString3)
 
-        n = self.NumberOfRvaAndSizes
-        info = self.process_table(tableString4, True)
-        format4, offsets, sizes, names, descriptions = '%dI' % (n * 2), xrange(self.size, self.size + n * 8, 4), [
-            4] * 2 * n, [], []
-        for i in xrange(n):
-            names += [info[2][i] + 'RVA', info[2][i] + 'Size']
-            descriptions += [info[3][i].replace('address and size.', 'RVA.'),
-                             info[3][i].replace('address and size.', 'size.')]
-        self.set_attributes(data, file_pointer, format4, offsets, sizes, names, descriptions)
+        self.set_attributes(data, file_pointer, get_data_directory_schema(self.size, self.NumberOfRvaAndSizes))
 
     def get_regions(self):
         r = [(self.fp, self.size, 'Optional Header')]
@@ -2,236 +2,652 @@
 
 import os
 import mmap
+import stat
 import struct
+import UserDict
 
 from Exception import *
 from Consts import *
 
+import AddressIndex
+import Checksum
+import Events
+import Fixup
 import COFFFileHeader
 import OptionalHeader
+import RegionMap
 import SectionHeader
+import SectionRegistry
 
 
-# import SectionText
-# import SectionRdata
-# import SectionData
-# import SectionIdata
-# import SectionRsrc
-# import SectionReloc
+class SectionMap(UserDict.DictMixin):
+    """Map section names to section objects, creating and parsing each one on first access."""
+
+    def __init__(self, pe):
+        self.pe = pe
+        self.loaded = {}
+
+    def __getitem__(self, name):
+        if name not in self.loaded:
+            for sh in self.pe.sh:
+                if sh.Name == name and sh.PointerToRawData != 0:
+                    self.loaded[name] = self.pe.load_section(sh)
+                    break
+            else:
+                raise KeyError(name)
+        return self.loaded[name]
+
+    def __setitem__(self, name, section):
+        self.loaded[name] = section
+
+    def __delitem__(self, name):
+        del self.loaded[name]
+
+    def __contains__(self, name):
+        return name in self.keys()
+
+    def keys(self):
+        names = [sh.Name for sh in self.pe.sh if sh.PointerToRawData != 0]
+        return names + [x for x in self.loaded if x not in names]
+
+    def is_loaded(self, name):
+        return name in self.loaded
 
 
 class PE:
-    """Parse a PE file."""
+    """Parse a PE file.
 
-    def __init__(self, filename, parse=True):
+    With lazy=True only the headers are parsed up front, and each section is parsed when it is first looked up in
+    self.sections. With a ParseCache, what an earlier parse of the same contents decoded is reused.
+    """
+
+    def __init__(self, filename, parse=True, lazy=False, cache=None):
         self.regions = []
         self.cfh = None
         self.oh = None
         self.sh = None
+        self.index = None
+        self.imports = None
+        self.exports = None
         self.sections = {}
+        self.lazy = lazy
+        self.owns_data = False
+        self.filename = None
+        self.section_states = {}
+        self.handlers = {}
+        self.unplaced = set()  # inserted sections with raw data, to be given a file pointer by calculate_new_address()
         self.__load__(filename)
         if parse:
-            self.parse()
-
-    def __load__(self, filename):
-        if filename:
-            stat = os.stat(filename)
-            if stat.st_size == 0:
-                raise PEFormatError('The file is empty')
+            if cache is None or not cache.load(self):
+                self.parse()
+                if cache is not None:
+                    cache.store(self)
+
+    def __load__(self, source):
+        """Load the image from a filename, the image itself (str, bytearray, memoryview, buffer), an mmap, or a file
+        object. A str holding a null byte is taken as the image, since a filename cannot hold one.
+
+        Files with a file descriptor are mapped, other file objects are read from the start."""
+
+        if source is None or isinstance(source, str) and not source:
+            return
+
+        if isinstance(source, mmap.mmap):
+            self.data = source
+        elif isinstance(source, str) and '\x00' not in source:
+            with open(source, 'rb') as fd:
+                self.__map__(fd.fileno())
+            self.filename = source
+        elif isinstance(source, str):
+            self.data = source
+        elif isinstance(source, memoryview):
+            self.data = source.tobytes()
+        elif isinstance(source, (bytearray, buffer)):
+            self.data = str(source)
+        elif hasattr(source, 'read'):
             try:
-                self.size = stat.st_size
-                fd = file(filename, 'rb')
-                self.fileno = fd.fileno()
-                if hasattr(mmap, 'MAP_PRIVATE'):
-                    # Unix
-                    self.data = mmap.mmap(self.fileno, 0, mmap.MAP_PRIVATE)
-                else:
-                    # Windows
-                    self.data = mmap.mmap(self.fileno, 0, access=mmap.ACCESS_READ)
-            finally:
-                fd.close()
+                fileno = source.fileno()
+            except (AttributeError, IOError, ValueError):
+                fileno = None
+            if fileno is not None:
+                self.__map__(fileno)
+            else:
+                source.seek(0)
+                self.data = source.read()
+        else:
+            raise TypeError('Cannot load a PE image from %s' % type(source).__name__)
+
+        self.size = len(self.data)
+        if self.size == 0:
+            raise PEFormatError('The file is empty')
+
+    def __map__(self, fileno):
+        if os.fstat(fileno).st_size == 0:
+            raise PEFormatError('The file is empty')
+        self.fileno = fileno
+        if hasattr(mmap, 'MAP_PRIVATE'):
+            # Unix
+            self.data = mmap.mmap(self.fileno, 0, mmap.MAP_PRIVATE)
+        else:
+            # Windows
+            self.data = mmap.mmap(self.fileno, 0, access=mmap.ACCESS_READ)
+        self.owns_data = True
+
+    def close(self):
+        """Unmap the file, if it was mapped by this object."""
+        if self.owns_data:
+            self.data.close()
+            self.owns_data = False
 
     def parse(self):
         fp, = struct.unpack_from('I', self.data, FILE_OFFSET_TO_PE_SIGNATURE)
-        print 'File pointer at 0x3c is 0x%x' % fp
         signature, = struct.unpack_from('4s', self.data, fp)
-        print 'Signature at 0x%x is %s' % (fp, repr(signature))
+        if Events.active:
+            Events.emit('parse', 'signature', 'Signature at 0x%x (from 0x3c) is %r', fp, signature, fp=fp)
         fp += 4
-        self.regions = [(0, fp, 'MS-DOS Header')]
 
-        print 'Parsing COFF File Header from 0x%x ... ' % fp,
         self.cfh = COFFFileHeader.COFFFileHeader(self.data, fp)
-        print '%d bytes done' % self.cfh.size
+        if Events.active:
+            Events.emit('parse', 'coff_header', 'Parsed COFF File Header from 0x%x, %d bytes', fp, self.cfh.size,
+                        fp=fp, size=self.cfh.size)
         fp += self.cfh.size
-        self.regions += self.cfh.get_regions()
 
-        print 'Parsing Optional Header from 0x%x ... ' % fp,
         self.oh = OptionalHeader.OptionalHeader(self.data, fp)
-        print '%d bytes done' % self.oh.size
+        if Events.active:
+            Events.emit('parse', 'optional_header', 'Parsed Optional Header from 0x%x, %d bytes', fp, self.oh.size,
+                        fp=fp, size=self.oh.size)
         fp += self.oh.size
-        self.regions += self.oh.get_regions()
 
-        print 'Parsing %d Section Headers from 0x%x ... ' % (self.cfh.NumberOfSections, fp),
         self.sh = SectionHeader.get_sh(self.data, fp, self.cfh.NumberOfSections)
-        print '%d*%d bytes done' % (self.sh[0].size, len(self.sh))
-        fp += self.sh[0].size * self.cfh.NumberOfSections
+        if Events.active:
+            Events.emit('parse', 'section_headers', 'Parsed %d Section Headers from 0x%x, %d*%d bytes', len(self.sh), fp,
+                        self.sh[0].size, len(self.sh), fp=fp, size=self.sh[0].size * len(self.sh), count=len(self.sh))
+
+        self.index_headers()
+        self.load_sections()
+
+    def index_headers(self):
+        """Collect the regions of the headers and index the section table."""
+        self.regions = [(0, self.cfh.fp, 'MS-DOS Header')]
+        self.regions += self.cfh.get_regions()
+        self.regions += self.oh.get_regions()
         for sh in self.sh:
             self.regions += sh.get_regions()
+        self.index = AddressIndex.AddressIndex(self.sh)
+        self.handlers = dict([(sh.Name, SectionRegistry.get_handler(sh, self.oh)) for sh in self.sh])
+
+    def load_sections(self):
+        if self.lazy:
+            self.sections = SectionMap(self)
+            return
 
         for sh in self.sh:
             if sh.PointerToRawData == 0:
-                print 'Section %s has no raw data' % sh.Name
+                if Events.active:
+                    Events.emit('parse', 'no_raw_data', 'Section %s has no raw data', sh.Name, section=sh.Name)
                 continue
 
-            class_name = 'Section' + sh.Name[1:].capitalize()
-            m = __import__(class_name)
-            c = getattr(m, class_name)
-            s = c(self.data, sh.PointerToRawData, sh.SizeOfRawData, sh.VirtualAddress, sh.VirtualSize)
+            self.sections[sh.Name] = self.load_section(sh)
+
+    def load_section(self, sh):
+        """Create the section object described by a section header, with the class SectionRegistry picked for it when
+        the headers were indexed, and parse it. The section is read from where it was loaded, even if its header has
+        been moved for the new layout since."""
+        c = self.handlers[sh.Name]
+        fp, fsize, rva, vsize = self.index.loaded[sh.Name]
+        s = c(self.data, fp, fsize, rva, vsize)
+        s.name = sh.Name
+        if sh.Name in self.section_states:
+            s.set_state(self.section_states.pop(sh.Name))
+        else:
             s.parse(self.oh)
-            self.sections[sh.Name] = s
-            print s
+        if Events.active:
+            Events.emit('parse', 'section', '%s', s, section=sh.Name, fp=s.fp, rva=s.rva, size=s.size)
+        return s
 
-    def rva2fp(self, rva):
-        fp = []
+    def get_handled_section(self, handler):
+        """Return the first section with raw data handled by handler (a class, or the name of its module), or None."""
+        c = SectionRegistry.get_class(handler)
         for sh in self.sh:
-            if sh.VirtualAddress <= rva <= sh.VirtualAddress + sh.VirtualSize:
-                offset = rva - sh.VirtualAddress
-                if offset < sh.SizeOfRawData:
-                    fp.append(offset + sh.PointerToRawData)
-        assert len(fp) == 1
-        return fp[0]
+            if sh.PointerToRawData != 0 and self.handlers.get(sh.Name) is c:
+                return self.sections[sh.Name]
+        return None
+
+    def get_reloc(self):
+        """Return the section holding the base relocations, whatever its name, or None."""
+        return self.get_handled_section(SectionRegistry.HANDLERS['.reloc'])
+
+    def rva2fp(self, rva):
+        return self.index.rva2fp(rva)
 
     def fp2rva(self, fp):
-        rva = []
-        for sh in self.sh:
-            if sh.PointerToRawData <= fp < sh.PointerToRawData + sh.SizeOfRawData:
-                offset = fp - sh.PointerToRawData
-                if offset < sh.VirtualSize:
-                    rva.append(offset + sh.VirtualAddress)
-        assert len(rva) == 1
-        return rva[0]
+        return self.index.fp2rva(fp)
+
+    def rva2fp_array(self, rvas):
+        return self.index.rva2fp_array(rvas)
+
+    def fp2rva_array(self, fps):
+        return self.index.fp2rva_array(fps)
 
     def get_string_by_rva(self, rva):
         return self.get_string_by_file_pointer(self.rva2fp(rva))
 
     def get_string_by_file_pointer(self, file_pointer):
-        return self.data[file_pointer: self.data.find('\x00', file_pointer)]
+        """Return the null-terminated string at file_pointer, which may not run past the end of its section."""
+        limit = self.index.fp_limit(file_pointer) if self.index else None
+        ending = self.data.find('\x00', file_pointer, limit or self.size)
+        if ending < 0:
+            raise PEFormatError('Unterminated string at 0x%x' % file_pointer)
+        return self.data[file_pointer:ending]
+
+    def get_imports(self):
+        """Return the import index, built on first use."""
+        if self.imports is None:
+            import SectionIdata
+            self.imports = SectionIdata.ImportIndex(self)
+        return self.imports
+
+    def get_exports(self):
+        """Return the export index, built on first use."""
+        if self.exports is None:
+            import SectionEdata
+            self.exports = SectionEdata.ExportIndex(self)
+        return self.exports
+
+    def get_byte_stats(self, window=None, step=None):
+        """Return the Entropy.ByteStats of the headers, the sections and the overlay, see Entropy.analyze()."""
+        import Entropy
+        return Entropy.analyze(self, window, step)
+
+    def get_checksum(self):
+        """Return the checksum of the loaded image, which a valid image has in its CheckSum field."""
+        return Checksum.compute(self.data, self.oh.fp + OPTIONAL_HEADER_OFFSET_TO_CHECKSUM)
+
+    def get_all_regions(self):
+        """Return the regions described in headers, import tables and relocation blocks included, as file offsets.
+
+        Regions whose RVA is not mapped to the file are returned separately."""
+
+        regions = list(self.regions)
+        if self.oh.ImportTableRVA:
+            import SectionIdata
+            for idt in SectionIdata.get_idt(self.data, self.rva2fp(self.oh.ImportTableRVA)):
+                regions += idt.get_regions(self)
+        reloc = self.get_reloc()
+        if reloc is not None:
+            for brb in reloc.brt:
+                regions += brb.get_regions(self)
+
+        by_rva = [x for x in regions if x[-1] == 'RVA' and x[1] != 0]
+        result = [(x[0], x[0] + x[1], x[2]) for x in regions if len(x) == 3 and x[1] != 0]
+        unmapped = []
+        try:
+            starts = self.rva2fp_array([x[0] for x in by_rva])
+            endings = self.rva2fp_array([x[0] + x[1] for x in by_rva])
+            result += [(starts[i], endings[i], x[2]) for i, x in enumerate(by_rva)]
+        except PEFormatError:
+            for x in by_rva:
+                try:
+                    result.append((self.rva2fp(x[0]), self.rva2fp(x[0] + x[1]), x[2]))
+                except PEFormatError:
+                    unmapped.append(x)
+        return result, unmapped
 
     def check_regions(self):
-        """Scan the regions described in headers, and check whether they overlap or have gaps."""
-
-        regions = [(self.rva2fp(x[0]), self.rva2fp(x[0] + x[1]), x[2]) for x in self.regions if x[-1] == 'RVA' and x[0] + x[1] != 0]
-        regions += [(x[0], x[0] + x[1], x[2]) for x in self.regions if len(x) == 3 and x[0] + x[1] != 0]
-        regions.sort(key=lambda n: (n[0], -n[1]))
-
-        boundaries = [0, self.size]
-        for r in regions:
-            boundaries += [r[0], r[1]]
-        boundaries = list(set(boundaries))
-        boundaries.sort()
-
-        start = 0
-        for ending in boundaries:
-            print '%5x~%5x (%5d bytes) ' % (start, ending, ending - start),
-            while regions[0][1] <= start:
-                del regions[0]
-            for r in regions:
-                if start >= r[0]:
-                    if ending <= r[1]:
-                        print r[2] + ',',
-                    else:
-                        assert start >= r[1], 'something is wrong'
-                else:
-                    if ending <= r[0]:
-                        break
-                    else:
-                        assert 0, 'something is wrong'
-
-            print ''
-            start = ending
-        pass
+        """Scan the regions described in headers, and check whether they overlap or have gaps.
+
+        Return a RegionMap over all regions, and report every segment with the regions covering it."""
+
+        regions, unmapped = self.get_all_regions()
+        region_map = RegionMap.RegionMap(regions, self.size)
+
+        if Events.active:
+            for start, ending, covers in region_map.segments():
+                Events.emit('check_regions', 'segment', '%5x~%5x (%5d bytes)  %s', start, ending, ending - start,
+                            ''.join([r[2] + ', ' for r in covers]), fp=start, size=ending - start,
+                            regions=[r[2] for r in covers])
+            for a, b in region_map.overlaps():
+                Events.emit('check_regions', 'overlap', '%s (0x%x~0x%x) overlaps %s (0x%x~0x%x)', a[2], a[0], a[1],
+                            b[2], b[0], b[1], regions=[a[2], b[2]])
+            for x in unmapped:
+                Events.emit('check_regions', 'unmapped', '%s (RVA 0x%x, %d bytes) is not mapped to the file', x[2], x[0],
+                            x[1], rva=x[0], size=x[1], regions=[x[2]])
+        return region_map
 
     def calculate_new_size(self):
-        print 'Calculate new size for %d sections' % len(self.sh)
+        if Events.active:
+            Events.emit('calculate_new_size', 'start', 'Calculate new size for %d sections', len(self.sh), count=len(self.sh))
         for sh in self.sh:
             if sh.PointerToRawData == 0:
-                print 'Section %s has no raw data' % sh.Name
+                if Events.active:
+                    Events.emit('calculate_new_size', 'no_raw_data', 'Section %s has no raw data', sh.Name, section=sh.Name)
                 continue
 
             s = self.sections[sh.Name]
             s.calculate_new_size(self.oh.FileAlignment, self.oh.SectionAlignment)
-            sh.SizeOfRawData, sh.VirtualSize = s.fsize, s.vsize
-
-    def calculate_new_address(self):
-        print 'Calculate new address for %d sections' % len(self.sh)
-
-        fp, rva = 0x400, 0x1000
-
-        for sh in self.sh:
+            sh.SizeOfRawData, sh.VirtualSize = s.new_fsize, s.new_vsize
+
+        reloc = self.get_reloc()
+        if reloc is not None:
+            self.oh.BaseRelocationTableSize = reloc.new_size
+
+    def calculate_new_address(self, start=0):
+        """Lay the sections out one after the other, from the start-th one on; the ones before it keep their place.
+
+        The first section goes after the headers (SizeOfHeaders), each next one after the previous one, in the file
+        and in memory. SizeOfImage follows the last section."""
+        if Events.active:
+            Events.emit('calculate_new_address', 'start', 'Calculate new address for %d sections', len(self.sh) - start,
+                        count=len(self.sh) - start)
+
+        fp, rva = self.oh.SizeOfHeaders, align(self.oh.SizeOfHeaders, self.oh.SectionAlignment)
+        if start > 0:
+            previous = self.sh[start - 1]
+            rva = align(previous.VirtualAddress + previous.VirtualSize, self.oh.SectionAlignment)
+            for sh in reversed(self.sh[:start]):
+                if sh.PointerToRawData != 0:
+                    fp = sh.PointerToRawData + sh.SizeOfRawData
+                    break
+
+        for sh in self.sh[start:]:
             sh.VirtualAddress = rva
-            rva += sh.VirtualSize
-            rva = rva if rva % self.oh.SectionAlignment == 0 else rva + self.oh.SectionAlignment - (
-                rva % self.oh.SectionAlignment)
+            rva = align(rva + sh.VirtualSize, self.oh.SectionAlignment)
 
-            if sh.PointerToRawData != 0:
+            if sh.PointerToRawData != 0 or sh.Name in self.unplaced:
                 sh.PointerToRawData = fp
                 fp += sh.SizeOfRawData
                 assert fp % self.oh.FileAlignment == 0
+                self.unplaced.discard(sh.Name)
+
+        self.oh.SizeOfImage = rva
 
     def relocate(self):
-        print 'Adjust addresses within %d sections' % len(self.sh)
+        if Events.active:
+            Events.emit('relocate', 'start', 'Adjust addresses within %d sections', len(self.sh), count=len(self.sh))
+
+        Fixup.Fixup(self).apply()
 
         for sh in self.sh:
             if sh.PointerToRawData == 0:
-                print 'Section %s has no raw data' % sh.Name
+                if Events.active:
+                    Events.emit('relocate', 'no_raw_data', 'Section %s has no raw data', sh.Name, section=sh.Name)
                 continue
 
             s = self.sections[sh.Name]
             s.relocate(sh.PointerToRawData, sh.VirtualAddress)
 
-    def write(self, filename):
-        data = self.data[:self.cfh.fp]
+        reloc = self.get_reloc()
+        if reloc is not None:
+            self.oh.BaseRelocationTableRVA = reloc.new_rva  # write() puts the table at the start of its section
+
+    def layout_size(self):
+        """Return the size of the file that write() will produce."""
+        size = self.cfh.fp + self.cfh.size + self.oh.size + sum([sh.size for sh in self.sh])
+        if size % self.oh.FileAlignment != 0:
+            size += self.oh.FileAlignment - size % self.oh.FileAlignment
+
+        for sh in self.sh:
+            if sh.PointerToRawData == 0:
+                continue
+            if sh.PointerToRawData < size:
+                raise PEFormatError('Section %s at 0x%x overlaps the headers or the previous section (0x%x)' % (
+                    sh.Name, sh.PointerToRawData, size))
+            size = sh.PointerToRawData + self.sections[sh.Name].new_fsize
+
+        return size + 0x200  # .reloc has trailing null bytes, no idea what they are
 
-        print 'Writing COFF File Header at 0x%x ... ' % len(data)
-        data += self.cfh.write()
+    def write_headers(self, buf):
+        """Serialize the headers into buf, after the bytes before the COFF File Header, return where they end."""
+        buf[:self.cfh.fp] = buffer(self.data, 0, self.cfh.fp)
+        fp = self.cfh.fp
 
-        print 'Writing Optional Header at 0x%x ... ' % len(data)
-        data += self.oh.write()
+        if Events.active:
+            Events.emit('write', 'coff_header', 'Writing COFF File Header at 0x%x ... ', fp, fp=fp, size=self.cfh.size)
+        fp = self.cfh.write_into(buf, fp)
 
-        print 'Writing %d Section Headers at 0x%x ... ' % (len(self.sh), len(data))
+        if Events.active:
+            Events.emit('write', 'optional_header', 'Writing Optional Header at 0x%x ... ', fp, fp=fp, size=self.oh.size)
+        fp = self.oh.write_into(buf, fp)
+
+        if Events.active:
+            Events.emit('write', 'section_headers', 'Writing %d Section Headers at 0x%x ... ', len(self.sh), fp, fp=fp,
+                        count=len(self.sh))
         for sh in self.sh:
-            data += sh.write()
+            fp = sh.write_into(buf, fp)
+        return fp
+
+    def is_dirty(self, s):
+        """Tell whether a section has to be serialized, or its bytes in the source can be copied as they are.
+
+        Sections set their dirty attribute when their contents stop matching the bytes at their fp in the source."""
+        return s.dirty or s.new_size != s.size
 
-        if len(data) % self.oh.FileAlignment != 0:
-            print 'Writting padding at 0x%x' % len(data)
-            data += '\x00' * (self.oh.FileAlignment - len(data) % self.oh.FileAlignment)
+    def build(self):
+        """Serialize every header and section at its final offset into one preallocated buffer, and refresh its CheckSum."""
+        data = bytearray(self.layout_size())
+        self.write_headers(data)
 
         for sh in self.sh:
             if sh.PointerToRawData == 0:
-                print 'Section %s has no raw data' % sh.Name
+                if Events.active:
+                    Events.emit('write', 'no_raw_data', 'Section %s has no raw data', sh.Name, section=sh.Name)
                 continue
 
             s = self.sections[sh.Name]
-            print 'Writing %s Section to 0x%x ... ' % (sh.Name, len(data))
-            data += s.write()
-            if s.new_fsize != s.new_size:
-                print 'Writing padding (0x%x bytes) at 0x%x' % ((s.new_fsize - s.new_size), len(data))
-                data += '\x00' * (s.new_fsize - s.new_size)
-
-        data += '\x00' * 0x200  # .reloc has trailing null bytes, no idea what they are
-        f = open(filename, 'wb')
-        f.write(data)
+            if Events.active:
+                Events.emit('write', 'section', 'Writing %s Section to 0x%x ... ', sh.Name, sh.PointerToRawData,
+                            section=sh.Name, fp=sh.PointerToRawData, size=s.new_size)
+            s.write_into(data, sh.PointerToRawData)
+
+        self.oh.CheckSum = Checksum.compute(data, self.oh.fp + OPTIONAL_HEADER_OFFSET_TO_CHECKSUM)
+        struct.pack_into('<I', data, self.oh.fp + OPTIONAL_HEADER_OFFSET_TO_CHECKSUM, self.oh.CheckSum)
         return data
 
-    def insert_section(self, sh, position):
-        """Insert a new section into PE file."""
+    def write(self, filename, trust_checksum=False):
+        """Save the image to filename, return its size.
+
+        Only the headers and the dirty sections are serialized; the clean sections are copied from the source file to
+        filename, by the kernel where the platform allows it. Images not loaded from a file, overwriting the source,
+        and destinations which are not regular files go through build() instead. Either way, the CheckSum field of the
+        new image is refreshed.
+
+        With trust_checksum, the clean sections are not read to be summed when the source has a CheckSum: their words
+        add up to the word sum it stores, less the words of whatever else the source holds. Only use it for sources
+        whose CheckSum is known to be right; a wrong one gives an image whose CheckSum is wrong by as much."""
+
+        if self.filename is None or os.path.exists(filename) and os.path.samefile(filename, self.filename):
+            data = self.build()
+            with open(filename, 'wb') as f:
+                f.write(data)
+            return len(data)
+
+        size = self.layout_size()
+        with open(filename, 'wb') as f, open(self.filename, 'rb') as source:
+            if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                f.write(self.build())
+                return size
+
+            out = f.fileno()
+            os.ftruncate(out, size)  # the gaps between sections read as zeros
+            # the checksum is summed up from the pieces as they are written, the headers go last, with it
+            self.oh.CheckSum = 0
+            headers = bytearray(self.cfh.fp + self.cfh.size + self.oh.size + sum([sh.size for sh in self.sh]))
+            self.write_headers(headers)
+            word_sum = Checksum.get_word_sum(headers)
+            checksum_fp = self.oh.fp + OPTIONAL_HEADER_OFFSET_TO_CHECKSUM
+            stored_sum = None
+            if trust_checksum:
+                stored_sum = Checksum.get_stored_word_sum(struct.unpack_from('<I', self.data, checksum_fp)[0], self.size)
+            clean = []
+
+            for sh in self.sh:
+                if sh.PointerToRawData == 0:
+                    if Events.active:
+                        Events.emit('write', 'no_raw_data', 'Section %s has no raw data', sh.Name, section=sh.Name)
+                    continue
+
+                s = self.sections[sh.Name]
+                if self.is_dirty(s):
+                    if Events.active:
+                        Events.emit('write', 'section', 'Writing %s Section to 0x%x ... ', sh.Name, sh.PointerToRawData,
+                                    section=sh.Name, fp=sh.PointerToRawData, size=s.new_size)
+                    data = bytearray(s.new_size)
+                    s.write_into(data, 0)
+                    write_at(out, sh.PointerToRawData, data)
+                    word_sum += Checksum.get_word_sum(data)
+                else:
+                    if Events.active:
+                        Events.emit('write', 'copy', 'Copying %s Section from 0x%x to 0x%x ... ', sh.Name, s.fp,
+                                    sh.PointerToRawData, section=sh.Name, fp=sh.PointerToRawData, size=s.new_size)
+                    copy_range(source.fileno(), out, s.fp, sh.PointerToRawData, s.new_size, self.data)
+                    clean.append((s.fp, s.fp + s.new_size))
+
+            clean.sort()
+            if stored_sum is not None and all([a[1] <= b[0] for a, b in zip(clean, clean[1:])]):
+                word_sum += stored_sum - Checksum.get_word_sum_outside(self.data, clean, checksum_fp)
+            else:
+                word_sum += sum([Checksum.get_word_sum(self.data, start, end) for start, end in clean])
+            self.oh.CheckSum = Checksum.get_checksum(word_sum, size)
+            struct.pack_into('<I', headers, self.oh.fp + OPTIONAL_HEADER_OFFSET_TO_CHECKSUM, self.oh.CheckSum)
+            write_at(out, 0, headers)
+        return size
+
+    def get_headers_size(self, number_of_sections):
+        """Return the size of the headers with number_of_sections section headers, aligned on FileAlignment."""
+        size = self.cfh.fp + self.cfh.size + self.oh.size + SectionHeader.SectionHeader.schema.size * number_of_sections
+        return align(size, self.oh.FileAlignment)
+
+    def insert_section(self, sh, position, data=''):
+        """Insert a new section into PE file.
+
+        sh is the header of the new section (see SectionHeader.make_sh()) and data its raw contents. The sections from
+        position on are moved after it, the ones before it keep their place. Nothing is changed if the section table
+        cannot grow: when the headers would run into the first section in memory. When they only run into it in the
+        file, SizeOfHeaders grows and every section moves in the file, but not in memory."""
         assert position <= len(self.sh)
-
-        self.sh[position:position] = sh
-        pass
+        if sh.Name in self.handlers or sh.Name in self.sections:
+            raise PEFormatError('There is a section %s already' % sh.Name)
+        if sh.VirtualSize == 0 and not data:
+            raise PEFormatError('Section %s is empty: it needs a VirtualSize or data' % sh.Name)
+
+        start = position
+        headers_size = self.get_headers_size(len(self.sh) + 1)
+        if headers_size > self.oh.SizeOfHeaders:
+            first_rva = min([x.VirtualAddress for x in self.sh] or [headers_size])
+            if headers_size > first_rva:
+                raise PEFormatError('No room for another section header: the headers would end at 0x%x, after the '
+                                    'first section at RVA 0x%x' % (headers_size, first_rva))
+            self.oh.SizeOfHeaders = headers_size
+            start = 0
+
+        import SectionRaw
+        sh.VirtualSize = max(sh.VirtualSize, len(data))
+        sh.SizeOfRawData = align(len(data), self.oh.FileAlignment)
+        data = data.ljust(min(sh.SizeOfRawData, sh.VirtualSize), '\x00')
+        sh.PointerToRawData = 0
+        s = SectionRaw.SectionRaw(data, 0, sh.SizeOfRawData, 0, sh.VirtualSize)
+        s.name = sh.Name
+        s.parse(self.oh)
+        s.calculate_new_size(self.oh.FileAlignment, self.oh.SectionAlignment)
+        s.dirty = True  # nothing to copy from the source
+
+        self.sh[position:position] = [sh]
+        self.cfh.NumberOfSections = len(self.sh)
+        self.handlers[sh.Name] = SectionRaw.SectionRaw
+        if data:
+            self.sections[sh.Name] = s
+            self.unplaced.add(sh.Name)
+        if Events.active:
+            Events.emit('calculate_new_address', 'insert', 'Inserted section %s at %d', sh.Name, position,
+                        section=sh.Name, count=len(self.sh))
+        self.calculate_new_address(start)
+        return s
+
+    def remove_section(self, name):
+        """Remove a section from the PE file, move the sections after it back, and return it.
+
+        The data directories pointing into it are cleared, and so are the base relocations of locations in it. Other
+        pointers into it are left as they are."""
+        position = [x.Name for x in self.sh].index(name)
+        sh = self.sh[position]
+        s = self.sections[name] if sh.PointerToRawData != 0 or name in self.unplaced else None
+
+        reloc = self.get_reloc()
+        if reloc is s:
+            reloc = None
+        if reloc is not None:
+            rvas, types = reloc.get_locations()
+            if any([sh.VirtualAddress <= x < sh.VirtualAddress + sh.VirtualSize for x in rvas]):
+                reloc.set_locations([x for x in rvas if not sh.VirtualAddress <= x < sh.VirtualAddress + sh.VirtualSize])
+        for rva_name in self.oh.schemas[-1].names[::2]:
+            if rva_name != 'CertificateTableRVA' and sh.VirtualAddress <= getattr(self.oh, rva_name) < \
+                    sh.VirtualAddress + max(sh.VirtualSize, sh.SizeOfRawData):
+                setattr(self.oh, rva_name, 0)
+                setattr(self.oh, rva_name[:-3] + 'Size', 0)
+
+        del self.sh[position]
+        self.cfh.NumberOfSections = len(self.sh)
+        self.handlers.pop(name, None)
+        self.unplaced.discard(name)
+        if s is not None:
+            del self.sections[name]
+        if Events.active:
+            Events.emit('calculate_new_address', 'remove', 'Removed section %s from %d', name, position, section=name,
+                        count=len(self.sh))
+        self.calculate_new_address(position)
+        return s
+
+
+def align(value, alignment):
+    return value + (alignment - value % alignment) % alignment
+
+
+def write_at(fd, offset, data):
+    os.lseek(fd, offset, os.SEEK_SET)
+    done = 0
+    while done < len(data):
+        done += os.write(fd, buffer(data, done))
+
+
+def copy_range(src, dst, src_offset, dst_offset, count, data):
+    """Copy count bytes from src_offset in file descriptor src to dst_offset in dst.
+
+    The copy stays in the kernel with os.copy_file_range or os.sendfile where they exist (Python 3 on Linux). Otherwise
+    the bytes are written from data, the mapped source, which still spares a copy into a Python string."""
+
+    copy_file_range = getattr(os, 'copy_file_range', None)
+    if copy_file_range is not None:
+        try:
+            while count:
+                n = copy_file_range(src, dst, count, src_offset, dst_offset)
+                if n == 0:
+                    break
+                src_offset, dst_offset, count = src_offset + n, dst_offset + n, count - n
+        except OSError:
+            pass  # not supported between these files, try the next way
+        if not count:
+            return
+
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is not None:
+        os.lseek(dst, dst_offset, os.SEEK_SET)
+        try:
+            while count:
+                n = sendfile(dst, src, src_offset, count)
+                if n == 0:
+                    break
+                src_offset, dst_offset, count = src_offset + n, dst_offset + n, count - n
+        except OSError:
+            pass
+        if not count:
+            return
+
+    write_at(dst, dst_offset, buffer(data, src_offset, count))
 
 
 def test():
+    import Diff
+
     pe = PE('helloworld.exe')
 
     old_data = pe.data
@@ -239,14 +655,17 @@ def test():
     pe.calculate_new_size()
     pe.calculate_new_address()
     pe.relocate()
-    new_data = pe.write('2.exe')
+    pe.write('2.exe')
+    with open('2.exe', 'rb') as f:
+        new_data = f.read()
 
     print 'old=0x%x, new=0x%x' % (len(old_data), len(new_data))
-    for i in range(len(old_data)):
-        if i < len(new_data):
-            assert old_data[i] == new_data[i], (i, hex(i), old_data[i], new_data[i])
-        else:
-            assert old_data[i] == '\x00', (i, old_data[i])
+    changes = Diff.diff(old_data, new_data, pe)
+    for change in changes:
+        print change
+    # only the checksum may change, and the new image may end with null bytes
+    assert all([c.owners[-1:] == ['Optional Header.CheckSum'] or c.start >= len(old_data) and
+                not new_data[c.start:c.end].strip('\x00') for c in changes])
 
 
 if __name__ == '__main__':
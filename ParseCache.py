@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+import errno
+import heapq
+import struct
+import weakref
+import hashlib
+import marshal
+import tempfile
+
+from Exception import *
+
+import BasicHeader
+import COFFFileHeader
+import Events
+import OptionalHeader
+import SectionHeader
+import SectionIdata
+
+
+# bump whenever parsing changes what it decodes, entries of other versions are never read
+PARSER_VERSION = 1
+
+# errors which only mean the import index could not be built, the image itself parsed fine
+IMPORT_ERRORS = (AssertionError, VEException, struct.error)
+
+# errors reading an entry which make it a miss: missing, truncated, or not written by this version
+ENTRY_ERRORS = (IOError, OSError, EOFError, ValueError, TypeError, KeyError)
+
+# the directory is scanned again every SCAN_INTERVAL stores, to see the entries other processes stored or removed
+SCAN_INTERVAL = 1000
+
+# temporary files older than this (in seconds) were left by a process which died while storing an entry
+STALE_TEMP_AGE = 3600
+
+
+def get_optional_header_schemas(number_of_rva_and_sizes):
+    """Return the schemas OptionalHeader.parse() uses for a PE32 image, in order."""
+    return (BasicHeader.get_schema(OptionalHeader.format1, OptionalHeader.tableString1),
+            BasicHeader.get_schema(OptionalHeader.format2, OptionalHeader.tableString2),
+            BasicHeader.get_schema(OptionalHeader.format3, OptionalHeader.tableString3),
+            OptionalHeader.get_data_directory_schema(96, number_of_rva_and_sizes))
+
+
+class ParseCache:
+    """Keep what PE.parse() decodes on disk, keyed by the SHA-1 of the image and PARSER_VERSION.
+
+    An entry holds the header fields, the section table, the decoded state of the sections which have one (.idata
+    and .reloc, their arrays as strings) and the import index, marshalled. Loading an entry rebuilds the headers and
+    sections from those values without decoding the image. Entries are files in directory; a hit refreshes the
+    modification time of its file, and the least recently used files are removed once they add up to more than
+    max_size bytes.
+
+    The modification times and sizes of the entries are kept in memory, so that a store does not scan the directory.
+    The directory is scanned on the first store and every SCAN_INTERVAL stores after it, which also removes the
+    temporary files of stores that never finished.
+    """
+
+    def __init__(self, directory, max_size=256 * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        self.paths = weakref.WeakKeyDictionary()  # hashing is the costly part of a lookup, do it once per PE
+        self.entries = None  # path -> (mtime, size), once scanned
+        self.heap = []  # (mtime, path), stale once entries has another mtime for path
+        self.total = 0
+        self.stores = 0
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):  # another process may have created it
+                    raise
+
+    def get_path(self, pe):
+        if pe not in self.paths:
+            digest = hashlib.sha1(pe.data).hexdigest()
+            self.paths[pe] = os.path.join(self.directory, '%s-%d.cache' % (digest, PARSER_VERSION))
+        return self.paths[pe]
+
+    def load(self, pe):
+        """Restore the parse of pe from the cache, return False on a miss."""
+        path = self.get_path(pe)
+        try:
+            with open(path, 'rb') as f:
+                entry = marshal.load(f)
+            (cfh_fp, cfh_values), (oh_fp, oh_values) = entry['cfh'], entry['oh']
+            data_directories, sh, sections = entry['data_directories'], entry['sh'], dict(entry['sections'])
+            imports = entry['imports']
+            os.utime(path, None)
+        except ENTRY_ERRORS:
+            if Events.active:
+                Events.emit('parse', 'cache_miss', 'Parse cache miss for %s', os.path.basename(path), path=path)
+            return False
+        self.add_entry(path)
+
+        pe.cfh = COFFFileHeader.COFFFileHeader.restore(
+            pe.data, cfh_fp, cfh_values, (BasicHeader.get_schema(COFFFileHeader.format1, COFFFileHeader.tableString1),))
+        pe.oh = OptionalHeader.OptionalHeader.restore(pe.data, oh_fp, oh_values,
+                                                      get_optional_header_schemas(data_directories))
+        pe.sh = [SectionHeader.SectionHeader.restore(pe.data, fp, values) for fp, values in sh]
+        pe.section_states = sections
+        if imports is not None:
+            pe.imports = SectionIdata.ImportIndex()
+            pe.imports.set_state(imports)
+
+        if Events.active:
+            Events.emit('parse', 'cache_hit', 'Parse cache hit for %s', os.path.basename(path), path=path)
+        pe.index_headers()
+        pe.load_sections()
+        return True
+
+    def store(self, pe):
+        """Save the parse of pe, which loads every section of a lazy PE, then evict entries over the size cap."""
+        sections = {}
+        for name in pe.sections.keys():
+            s = pe.sections[name]
+            if hasattr(s, 'get_state'):
+                sections[name] = s.get_state()
+        try:
+            imports = pe.get_imports().get_state()
+        except IMPORT_ERRORS:
+            imports = None
+
+        entry = {
+            'cfh': (pe.cfh.fp, pe.cfh.get_values()),
+            'oh': (pe.oh.fp, pe.oh.get_values()),
+            'data_directories': pe.oh.NumberOfRvaAndSizes,
+            'sh': [(sh.fp, sh.get_values()) for sh in pe.sh],
+            'sections': sections,
+            'imports': imports,
+        }
+
+        # written aside and renamed, so that other processes never read a partial entry
+        fd, temp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(entry, f)
+            os.rename(temp, self.get_path(pe))
+        except:
+            os.remove(temp)
+            raise
+
+        if self.entries is None or self.stores % SCAN_INTERVAL == 0:
+            self.scan()
+        else:
+            self.add_entry(self.get_path(pe))
+        self.stores += 1
+        self.evict()
+
+    def scan(self):
+        """Index the entries in the directory, and remove the stale temporary files."""
+        self.entries, self.heap, self.total = {}, [], 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+                if name.endswith('.tmp') and now - st.st_mtime > STALE_TEMP_AGE:
+                    os.remove(path)
+            except OSError:
+                continue  # removed by another process
+            if name.endswith('.cache'):
+                self.entries[path] = (st.st_mtime, st.st_size)
+                self.total += st.st_size
+        self.heap = [(mtime, path) for path, (mtime, size) in self.entries.items()]
+        heapq.heapify(self.heap)
+
+    def add_entry(self, path):
+        """Record the modification time and size of an entry just stored or used, once the directory is indexed."""
+        if self.entries is None:
+            return
+        try:
+            st = os.stat(path)
+        except OSError:
+            return
+        self.total += st.st_size - self.entries.get(path, (0, 0))[1]
+        self.entries[path] = (st.st_mtime, st.st_size)
+        heapq.heappush(self.heap, (st.st_mtime, path))
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits in max_size."""
+        if self.entries is None:
+            self.scan()
+        while self.total > self.max_size and self.heap:
+            mtime, path = heapq.heappop(self.heap)
+            if self.entries.get(path, (None,))[0] != mtime:
+                continue  # used again since
+            try:
+                os.remove(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:  # removed by another process already
+                    raise
+            self.total -= self.entries.pop(path)[1]
+            if Events.active:
+                Events.emit('parse', 'cache_evict', 'Evicted %s from the parse cache', os.path.basename(path), path=path)
+
+
+if __name__ == '__main__':
+    import shutil
+    import PE
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = ParseCache(directory)
+        pe = PE.PE('helloworld.exe', cache=cache)
+        cached = PE.PE('helloworld.exe', cache=cache)
+        assert [sh.get_values() for sh in cached.sh] == [sh.get_values() for sh in pe.sh]
+        assert str(cached.get_imports()) == str(pe.get_imports())
+    finally:
+        shutil.rmtree(directory)
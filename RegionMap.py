@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+import bisect
+import heapq
+
+
+class RegionMap:
+    """Index the regions of a file to find what covers an offset, the gaps and the overlaps.
+
+    Regions are (start, end, name) tuples of file offsets. The file is cut into segments at every region boundary,
+    and each segment keeps the regions covering it, outermost first, so that covering() is a binary search.
+    Partial overlaps (two regions which intersect without one containing the other) are found by a sweep over the
+    regions sorted by start, with the open regions kept sorted by end.
+    """
+
+    def __init__(self, regions, size):
+        self.size = size
+        self.regions = sorted([x for x in regions if x[1] > x[0]], key=lambda x: (x[0], -x[1], x[2]))
+
+        self.bounds = sorted(set([0, size] + [x[0] for x in self.regions] + [x[1] for x in self.regions]))
+        self.covers = []
+        active, ends, i = [], [], 0
+        for start in self.bounds[:-1]:
+            while ends and ends[0][0] <= start:
+                active.remove(heapq.heappop(ends)[1])
+            while i < len(self.regions) and self.regions[i][0] <= start:
+                active.append(self.regions[i])
+                heapq.heappush(ends, (self.regions[i][1], self.regions[i]))
+                i += 1
+            self.covers.append(tuple(active))
+
+        self.partial = []
+        opened, open_ends = [], []
+        for r in self.regions:
+            n = bisect.bisect_right(open_ends, r[0])
+            del opened[:n], open_ends[:n]
+            # every open region starts before r and ends after r starts, those ending before r ends cross it
+            for other in opened[:bisect.bisect_left(open_ends, r[1])]:
+                if other[0] < r[0]:
+                    self.partial.append((other, r))
+            j = bisect.bisect_right(open_ends, r[1])
+            opened.insert(j, r)
+            open_ends.insert(j, r[1])
+
+    def covering(self, offset):
+        """Return the regions covering offset, outermost first."""
+        i = bisect.bisect_right(self.bounds, offset) - 1
+        if 0 <= i < len(self.covers):
+            return self.covers[i]
+        return ()
+
+    def segments(self):
+        """Return (start, end, regions) for every segment between two region boundaries."""
+        return [(self.bounds[i], self.bounds[i + 1], self.covers[i]) for i in xrange(len(self.covers))]
+
+    def gaps(self):
+        """Return (start, end) of every part of the file not covered by any region."""
+        return [(self.bounds[i], self.bounds[i + 1]) for i in xrange(len(self.covers)) if not self.covers[i]]
+
+    def overlaps(self):
+        """Return every pair of regions which overlap without one containing the other."""
+        return self.partial
@@ -16,6 +16,9 @@ class RelocationEntry(BasicHeader.HomoHeader):
     For each section in an object file, an array of fixed-length records holds the section’s COFF relocations. The position and length of the array are specified in the section header.
     """
 
+    schema = BasicHeader.get_schema(format1, tableString1)
+    __slots__ = schema.names
+
     def parse(self, data, file_pointer):
         self.set_attributes_by_table(data, file_pointer, format1, tableString1)
 
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import Events
 
 
 class SectionData:
@@ -8,13 +9,14 @@ class SectionData:
         self.data, self.fp, self.fsize, self.rva, self.vsize = filedata, fp, fsize, rva, vsize
         self.size = min(fsize, vsize)
         self.bias = self.rva - self.fp
+        self.dirty = False
         self.items = []
 
         self.new_size, self.new_fsize, self.new_vsize = self.size, self.fsize, self.vsize
         self.new_fp, self.new_rva = self.fp, self.rva
 
     def parse(self, oh=None):
-        self.items = self.data[self.fp:self.fp + self.size]
+        self.items = buffer(self.data, self.fp, self.size)
 
     def __str__(self):
         s = 'Section .data, %d bytes from 0x%x, 0x%x\n' % (self.size, self.fp, self.rva)
@@ -26,26 +28,37 @@ class SectionData:
         self.new_size = len(self.items)
         if self.new_size == self.size:
             self.new_fsize, self.new_vsize = self.fsize, self.vsize
-            print '.data size unchanged. fsize=0x%x, vsize=0x%x' % (self.new_fsize, self.new_vsize)
+            if Events.active:
+                Events.emit('calculate_new_size', 'unchanged', '.data size unchanged. fsize=0x%x, vsize=0x%x', self.new_fsize,
+                            self.new_vsize, section='.data', fsize=self.new_fsize, vsize=self.new_vsize)
         else:
             assert False, '.data size 0x%x -> 0x%x, not implemented yet' % (self.size, self.new_size)
 
         assert self.new_fsize % file_alignment == 0
 
     def relocate(self, new_fp, new_rva):
-        """根据new_rva, new_size, new_fp等信息，重写数据"""
+        """根据new_rva, new_size, new_fp等信息，重写数据
+
+        Absolute pointers inside the section have already been fixed up by Fixup when the RVA changes."""
         self.new_fp, self.new_rva = new_fp, new_rva
-        if (self.fp, self.fsize, self.rva, self.vsize) == (self.new_fp, self.new_fsize, self.new_rva, self.new_vsize):
-            print '.data fp and rva unchanged. fp=0x%x, rva=0x%x' % (self.new_fp, self.new_rva)
-        else:
-            assert False, '.data fp 0x%x -> 0x%x, rva 0x%x -> 0x%x, not implemented yet' % (
-                self.fp, self.new_fp, self.rva, self.new_rva)
+        if (self.fp, self.rva) == (self.new_fp, self.new_rva):
+            if Events.active:
+                Events.emit('relocate', 'unchanged', '.data fp and rva unchanged. fp=0x%x, rva=0x%x', self.new_fp, self.new_rva,
+                            section='.data', fp=self.new_fp, rva=self.new_rva)
+        elif Events.active:
+            Events.emit('relocate', 'moved', '.data fp 0x%x -> 0x%x, rva 0x%x -> 0x%x', self.fp, self.new_fp, self.rva,
+                        self.new_rva, section='.data', fp=self.new_fp, rva=self.new_rva)
 
     def write(self):
         new_data = self.items
         assert len(new_data) == self.new_size
         return new_data
 
+    def write_into(self, buf, offset):
+        assert len(self.items) == self.new_size
+        buf[offset:offset + self.new_size] = self.items
+        return offset + self.new_size
+
 
 if __name__ == '__main__':
     import PE
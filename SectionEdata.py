@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+import array
+
+from Exception import *
+
+import BasicHeader
+import Events
+
+
+tableString1 = '''
+    0	4	Export Flags	Reserved, must be 0.
+    4	4	Time/Date Stamp	The time and date that the export data was created.
+    8	2	Major Version	The major version number. The major and minor version numbers can be set by the user.
+  10	2	Minor Version	The minor version number.
+  12	4	Name RVA	The address of the ASCII string that contains the name of the DLL. This address is relative to the image base.
+  16	4	Ordinal Base	The starting ordinal number for exports in this image. This field specifies the starting ordinal number for the export address table. It is usually set to 1.
+  20	4	Address Table Entries	The number of entries in the export address table.
+  24	4	Number of Name Pointers	The number of entries in the name pointer table. This is also the number of entries in the ordinal table.
+  28	4	Export Address Table RVA	The address of the export address table, relative to the image base.
+  32	4	Name Pointer RVA	The address of the export name pointer table, relative to the image base. The table size is given by the Number of Name Pointers field.
+  36	4	Ordinal Table RVA	The address of the ordinal table, relative to the image base.
+'''
+format1 = '2I 2H 7I'
+
+
+class ExportDirectoryTable(BasicHeader.HomoHeader):
+    """Represent the Export Directory Table.
+
+    The export symbol information begins with the export directory table, which describes the remainder of the export symbol information. The export directory table contains address information that is used to resolve imports to the entry points within this image.
+    """
+
+    schema = BasicHeader.get_schema(format1, tableString1)
+    __slots__ = schema.names
+
+    def parse(self, data, file_pointer):
+        self.set_attributes_by_table(data, file_pointer, format1, tableString1)
+
+
+class ExportIndex:
+    """Index the exports of an image.
+
+    The export address, name pointer and ordinal tables are read into arrays; a name is only decoded when a lookup or
+    a listing needs it. The name pointer table is sorted, so find() looks a name up by binary search, decoding about
+    log2(n) names. Exports are found by name or by (biased) ordinal, and resolve to an RVA, or to a 'DLL.symbol'
+    string for forwarders.
+    """
+
+    def __init__(self, pe):
+        self.pe = pe
+        self.directory = None
+        self.addresses = array.array('I')
+        self.name_rvas = array.array('I')
+        self.ordinals = array.array('H')
+        self.names = {}
+
+        if pe.oh.ExportTableRVA == 0:
+            return
+
+        self.directory = d = ExportDirectoryTable(pe.data, pe.rva2fp(pe.oh.ExportTableRVA))
+        self.addresses = self.read_array('I', d.ExportAddressTableRVA, d.AddressTableEntries)
+        self.name_rvas = self.read_array('I', d.NamePointerRVA, d.NumberofNamePointers)
+        self.ordinals = self.read_array('H', d.OrdinalTableRVA, d.NumberofNamePointers)
+
+    def read_array(self, typecode, rva, count):
+        items = array.array(typecode)
+        if count:
+            fp = self.pe.rva2fp(rva)
+            end = fp + count * items.itemsize
+            if end > self.pe.index.fp_limit(fp):
+                raise PEFormatError('Export table at 0x%x runs past the end of its section' % rva)
+            items.fromstring(self.pe.data[fp:end])
+        return items
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def get_dll_name(self):
+        return self.pe.get_string_by_rva(self.directory.NameRVA) if self.directory else None
+
+    def get_name(self, i):
+        """Return the i-th name of the name pointer table."""
+        if i not in self.names:
+            self.names[i] = self.pe.get_string_by_rva(self.name_rvas[i])
+        return self.names[i]
+
+    def find_name(self, name):
+        """Return the position of name in the name pointer table, or None."""
+        lo, hi = 0, len(self.name_rvas)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.get_name(mid) < name:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.name_rvas) and self.get_name(lo) == name:
+            return lo
+        return None
+
+    def resolve(self, i):
+        """Return the RVA of the i-th export address table entry, the forwarder string if it points into the export
+        directory, or None for an unused entry."""
+        rva = self.addresses[i]
+        if rva == 0:
+            return None
+        if 0 <= rva - self.pe.oh.ExportTableRVA < self.pe.oh.ExportTableSize:
+            return self.pe.get_string_by_rva(rva)
+        return rva
+
+    def find(self, symbol):
+        """Return what a name or an ordinal is exported as (see resolve()), or None if it is not exported."""
+        if isinstance(symbol, (int, long)):
+            i = symbol - self.directory.OrdinalBase if self.directory else -1
+        else:
+            i = self.find_name(symbol)
+            i = self.ordinals[i] if i is not None else -1
+        if 0 <= i < len(self.addresses):
+            return self.resolve(i)
+        return None
+
+    def get_ordinal(self, name):
+        i = self.find_name(name)
+        return self.ordinals[i] + self.directory.OrdinalBase if i is not None else None
+
+    def __str__(self):
+        names = dict(zip(self.ordinals, [self.get_name(i) for i in xrange(len(self.name_rvas))]))
+        s = '%s, %d exports, %d by name\n' % (self.get_dll_name(), len(self.addresses), len(self.name_rvas))
+        for i in xrange(len(self.addresses)):
+            target = self.resolve(i)
+            if target is not None:
+                target = '0x%08x' % target if isinstance(target, (int, long)) else '-> ' + target
+                s += '%5d %s %s\n' % (i + self.directory.OrdinalBase, target, names.get(i, ''))
+        return s
+
+
+class SectionEdata:
+    """Represent the .edata section.
+
+    The export tables are indexed by PE.get_exports(), wherever they are; the section itself is kept as it is."""
+
+    def __init__(self, filedata, fp, fsize, rva, vsize):
+        self.data = filedata
+        self.fp = fp
+        self.fsize = fsize
+        self.rva = rva
+        self.vsize = vsize
+        self.items = []
+
+        self.new_size = 0
+        self.new_rva = 0
+        self.new_vsize = 0
+        self.new_fp = 0
+        self.new_fsize = 0
+
+        self.size = min(fsize, vsize)
+        self.bias = self.rva - self.fp
+        self.dirty = False
+
+    def parse(self, oh=None):
+        self.items = buffer(self.data, self.fp, self.size)
+
+    def __str__(self):
+        s = 'Section .edata, %d bytes from 0x%x, 0x%x\n' % (self.size, self.fp, self.rva)
+        return s
+
+    def calculate_new_size(self, file_alignment, section_alignment):
+        self.new_size = len(self.items)
+        if self.new_size == self.size:
+            self.new_fsize, self.new_vsize = self.fsize, self.vsize
+            if Events.active:
+                Events.emit('calculate_new_size', 'unchanged', '.edata size unchanged. fsize=0x%x, vsize=0x%x', self.new_fsize,
+                            self.new_vsize, section='.edata', fsize=self.new_fsize, vsize=self.new_vsize)
+        else:
+            assert False, '.edata size 0x%x -> 0x%x, not implemented yet' % (self.size, self.new_size)
+
+        assert self.new_fsize % file_alignment == 0
+
+    def relocate(self, new_fp, new_rva):
+        """根据new_rva, new_size, new_fp等信息，重写数据
+
+        The RVAs in the export tables have already been moved by Fixup when the RVA changes."""
+        self.new_fp, self.new_rva = new_fp, new_rva
+        if (self.fp, self.rva) == (self.new_fp, self.new_rva):
+            if Events.active:
+                Events.emit('relocate', 'unchanged', '.edata fp and rva unchanged. fp=0x%x, rva=0x%x', self.new_fp, self.new_rva,
+                            section='.edata', fp=self.new_fp, rva=self.new_rva)
+        elif Events.active:
+            Events.emit('relocate', 'moved', '.edata fp 0x%x -> 0x%x, rva 0x%x -> 0x%x', self.fp, self.new_fp, self.rva,
+                        self.new_rva, section='.edata', fp=self.new_fp, rva=self.new_rva)
+
+    def write(self):
+        new_data = self.items
+        assert len(new_data) == self.new_size
+        return new_data
+
+    def write_into(self, buf, offset):
+        assert len(self.items) == self.new_size
+        buf[offset:offset + self.new_size] = self.items
+        return offset + self.new_size
+
+
+if __name__ == '__main__':
+    import PE
+    import SyntheticPE
+
+    pe = PE.PE(str(SyntheticPE.generate(exports=1000)))
+    exports = pe.get_exports()
+    print exports.get_dll_name(), len(exports)
+    assert exports.find('Export000500') == exports.find(exports.get_ordinal('Export000500'))
+    assert exports.find('Export001000') is None
+    assert len(exports.names) < 20
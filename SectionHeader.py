@@ -24,6 +24,9 @@ class SectionHeader(BasicHeader.HomoHeader):
     In an image file, the VAs for sections must be assigned by the linker so that they are in ascending order and adjacent, and they must be a multiple of the SectionAlignment value in the optional header.
     """
 
+    schema = BasicHeader.get_schema(format1, tableString1)
+    __slots__ = schema.names
+
     def parse(self, data, file_pointer):
         self.set_attributes_by_table(data, file_pointer, format1, tableString1)
 
@@ -47,6 +50,12 @@ def get_sh(data, file_pointer, num):
     return items
 
 
+def make_sh(name, virtual_size, characteristics):
+    """Return the header of a new section, to be placed by PE.insert_section()."""
+    values = [name, virtual_size, 0, 0, 0, 0, 0, 0, 0, characteristics]
+    return SectionHeader(SectionHeader.schema.struct.pack(*values), 0)
+
+
 if __name__ == '__main__':
     import PE
 
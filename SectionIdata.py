@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import array
 import struct
 
+from Exception import *
+
 import BasicHeader
+import Events
 
 
 tableString1 = '''
@@ -20,6 +24,9 @@ class ImportDirectoryTableEntry(BasicHeader.HomoHeader):
     The import information begins with the import directory table, which describes the remainder of the import information. The import directory table contains address information that is used to resolve fixup references to the entry points within a DLL image. The import directory table consists of an array of import directory entries, one entry for each DLL to which the image refers. The last directory entry is empty (filled with null values), which indicates the end of the directory table.
     """
 
+    schema = BasicHeader.get_schema(format1, tableString1)
+    __slots__ = schema.names
+
     def parse(self, data, file_pointer):
         self.set_attributes_by_table(data, file_pointer, format1, tableString1)
 
@@ -31,15 +38,11 @@ class ImportDirectoryTableEntry(BasicHeader.HomoHeader):
         r = [(self.fp, self.size, 'Import Directory Table for %s' % dll_name)]
 
         ilt_start_fp = pe.rva2fp(self.ImportLookupTableRVA)
-        ilt_end_fp = ilt_start_fp
-        while pe.data[ilt_end_fp: ilt_end_fp + 4] != '\x00' * 4:
-            ilt_end_fp += 4
+        ilt_end_fp = find_table_end(pe.data, ilt_start_fp, pe.index.fp_limit(ilt_start_fp))
         r.append((ilt_start_fp, ilt_end_fp - ilt_start_fp, 'Import Lookup Table for %s' % dll_name))
 
         iat_start_fp = pe.rva2fp(self.ImportAddressTableRVA)
-        iat_end_fp = iat_start_fp
-        while pe.data[iat_end_fp: iat_end_fp + 4] != '\x00' * 4:
-            iat_end_fp += 4
+        iat_end_fp = find_table_end(pe.data, iat_start_fp, pe.index.fp_limit(iat_start_fp))
         r.append((iat_start_fp, iat_end_fp - iat_start_fp, 'Import Address Table for %s' % dll_name))
 
         return r
@@ -57,6 +60,91 @@ def get_idt(data, file_pointer):
     return items
 
 
+def find_table_end(data, file_pointer, limit):
+    """Return the file pointer of the null entry which terminates a table of 32-bit entries.
+
+    The search is done by data.find() and may not run past limit."""
+
+    pos = file_pointer
+    while True:
+        pos = data.find('\x00' * 4, pos, limit)
+        if pos < 0:
+            raise PEFormatError('Unterminated table at 0x%x' % file_pointer)
+        if (pos - file_pointer) % 4 == 0:
+            return pos
+        pos += 4 - (pos - file_pointer) % 4
+
+
+class ImportIndex:
+    """Index all imports of an image in one pass over the import directory.
+
+    dlls maps each DLL name to a list of (name or ordinal, hint, IAT slot RVA), in import order. Symbols are looked up
+    by find(), with DLL names matched case-insensitively. Imports by ordinal have no hint.
+    """
+
+    def __init__(self, pe=None):
+        self.dlls = {}
+        self.order = []
+        self.by_symbol = {}
+        self.by_name = {}
+
+        if pe is None or pe.oh.ImportTableRVA == 0:
+            return
+
+        data, index = pe.data, pe.index
+        for idt in get_idt(data, pe.rva2fp(pe.oh.ImportTableRVA)):
+            dll = pe.get_string_by_rva(idt.NameRVA)
+
+            # the ILT may be missing in old images, the IAT is identical until the image is bound
+            ilt_fp = pe.rva2fp(idt.ImportLookupTableRVA or idt.ImportAddressTableRVA)
+            words = array.array('I')
+            words.fromstring(data[ilt_fp:find_table_end(data, ilt_fp, index.fp_limit(ilt_fp))])
+
+            symbols = []
+            for i, value in enumerate(words):
+                iat_rva = idt.ImportAddressTableRVA + 4 * i
+                if value >> 31:
+                    symbol, hint = value & 0xffff, None
+                else:
+                    hnt_fp = index.rva2fp(value & 0x7fffffff)
+                    hint, = struct.unpack_from('<H', data, hnt_fp)
+                    symbol = pe.get_string_by_file_pointer(hnt_fp + 2)
+                symbols.append((symbol, hint, iat_rva))
+            self.add(dll, symbols)
+
+    def add(self, dll, symbols):
+        for symbol, hint, iat_rva in symbols:
+            if hint is not None:
+                self.by_name.setdefault(symbol, []).append((dll, iat_rva))
+            self.by_symbol[(dll.lower(), symbol)] = (hint, iat_rva)
+        self.order.append(dll)
+        self.dlls[dll] = symbols
+
+    def get_state(self):
+        return [(dll, self.dlls[dll]) for dll in self.order]
+
+    def set_state(self, state):
+        for dll, symbols in state:
+            self.add(dll, [tuple(x) for x in symbols])
+
+    def __str__(self):
+        s = '%d DLLs, %d symbols imported\n' % (len(self.order), len(self.by_symbol))
+        for dll in self.order:
+            for symbol, hint, iat_rva in self.dlls[dll]:
+                s += '0x%08x %s!%s\n' % (iat_rva, dll, symbol if hint is not None else '#%d' % symbol)
+        return s
+
+    def find(self, symbol, dll=None):
+        """Return the IAT slot RVA of a symbol (a name or an ordinal), or None if it is not imported.
+
+        Without dll, the first DLL the name is imported from is used."""
+        if dll is not None:
+            found = self.by_symbol.get((dll.lower(), symbol))
+            return found[1] if found else None
+        found = self.by_name.get(symbol)
+        return found[0][1] if found else None
+
+
 class ImportLookupTableEntry():
     """Import Lookup Table
 
@@ -121,6 +209,7 @@ class SectionIdata:
 
         self.size = min(fsize, vsize)
         self.bias = self.rva - self.fp
+        self.dirty = False
 
         self.idt_new_size = 0
         self.iat_new_size = 0
@@ -138,6 +227,9 @@ class SectionIdata:
     def __parse__(self, idt_start_rva, idt_size, iat_start_rva, iat_size):
         self.parse_idt(idt_start_rva, idt_size)
         self.parse_iat_ilt(iat_start_rva, iat_size)
+        # write() lays the tables out as IAT, IDT, ILT, hint/name table from the start of the section
+        self.dirty = (self.iat_fp, self.idt_fp, self.ilt_fp) != (
+            self.fp, self.fp + self.iat_size, self.fp + self.iat_size + self.idt_size)
 
     def parse_idt(self, idt_start_rva, idt_size):
         idt_start_fp = idt_start_rva - self.rva + self.fp
@@ -180,6 +272,29 @@ class SectionIdata:
         self.hnt_size = len(self.hnt_values)
         self.hnt_rva = self.hnt_fp + self.bias
 
+    def get_state(self):
+        """Return what parse() decoded, as plain values."""
+        return {
+            'idt': [(x.fp, x.get_values()) for x in self.idt],
+            'tables': (self.idt_fp, self.idt_size, self.iat_fp, self.iat_size, self.ilt_fp, self.ilt_size,
+                       self.hnt_fp, self.hnt_size),
+            'iat': array.array('I', self.iat_values).tostring(),
+            'ilt': array.array('I', self.ilt_values).tostring(),
+            'dirty': self.dirty,
+        }
+
+    def set_state(self, state):
+        """Take the place of parse() with the values get_state() returned."""
+        self.idt = [ImportDirectoryTableEntry.restore(self.data, fp, values) for fp, values in state['idt']]
+        (self.idt_fp, self.idt_size, self.iat_fp, self.iat_size, self.ilt_fp, self.ilt_size, self.hnt_fp,
+         self.hnt_size) = state['tables']
+        self.iat_values = tuple(array.array('I', state['iat']))
+        self.ilt_values = tuple(array.array('I', state['ilt']))
+        self.hnt_values = self.data[self.hnt_fp:self.hnt_fp + self.hnt_size]
+        self.idt_rva, self.iat_rva = self.idt_fp + self.bias, self.iat_fp + self.bias
+        self.ilt_rva, self.hnt_rva = self.ilt_fp + self.bias, self.hnt_fp + self.bias
+        self.dirty = state['dirty']
+
     def __str__(self):
         s = 'Section .idata, %d bytes from 0x%x, 0x%x\n' % (self.size, self.fp, self.rva)
         s += '%5d from 0x%x: IAT\n' % (self.iat_size, self.iat_fp)
@@ -198,35 +313,61 @@ class SectionIdata:
         assert self.iat_new_size == self.ilt_new_size
         if self.new_size == self.size:
             self.new_fsize, self.new_vsize = self.fsize, self.vsize
-            print '.idata size unchanged. fsize=0x%x, vsize=0x%x' % (self.new_fsize, self.new_vsize)
+            if Events.active:
+                Events.emit('calculate_new_size', 'unchanged', '.idata size unchanged. fsize=0x%x, vsize=0x%x', self.new_fsize,
+                            self.new_vsize, section='.idata', fsize=self.new_fsize, vsize=self.new_vsize)
         else:
             assert False, '.idata size 0x%x -> 0x%x, not implemented yet' % (self.size, self.new_size)
 
         assert self.new_fsize % file_alignment == 0
 
     def relocate(self, new_fp, new_rva):
-        """根据new_rva, new_size, new_fp等信息，重写数据"""
+        """根据new_rva, new_size, new_fp等信息，重写数据
+
+        The RVAs inside the import tables all point into this section, so they move with it."""
         self.new_fp, self.new_rva = new_fp, new_rva
-        if (self.fp, self.fsize, self.rva, self.vsize) == (self.new_fp, self.new_fsize, self.new_rva, self.new_vsize):
-            print '.idata fp and rva unchanged. fp=0x%x, rva=0x%x' % (self.new_fp, self.new_rva)
-        else:
-            assert False, '.idata fp 0x%x -> 0x%x, rva 0x%x -> 0x%x, not implemented yet' % (
-                self.fp, self.new_fp, self.rva, self.new_rva)
+        if (self.fp, self.rva) == (self.new_fp, self.new_rva):
+            if Events.active:
+                Events.emit('relocate', 'unchanged', '.idata fp and rva unchanged. fp=0x%x, rva=0x%x', self.new_fp, self.new_rva,
+                            section='.idata', fp=self.new_fp, rva=self.new_rva)
+            return
+
+        delta = self.new_rva - self.rva
+        self.dirty = self.dirty or delta != 0
+        for idt in self.idt:
+            idt.ImportLookupTableRVA += delta
+            idt.NameRVA += delta
+            idt.ImportAddressTableRVA += delta
+        # entries are hint/name RVAs, unless they are ordinals (bit 31) or terminators
+        self.iat_values = tuple([x + delta if x and not x >> 31 else x for x in self.iat_values])
+        self.ilt_values = tuple([x + delta if x and not x >> 31 else x for x in self.ilt_values])
+        if Events.active:
+            Events.emit('relocate', 'moved', '.idata fp 0x%x -> 0x%x, rva 0x%x -> 0x%x', self.fp, self.new_fp, self.rva,
+                        self.new_rva, section='.idata', fp=self.new_fp, rva=self.new_rva)
 
     def write(self):
-        new_data = struct.pack('<%dI' % len(self.iat_values), *self.iat_values)
+        new_data = bytearray(self.new_size)
+        self.write_into(new_data, 0)
+        return str(new_data)
+
+    def write_into(self, buf, offset):
+        start = offset
+
+        struct.pack_into('<%dI' % len(self.iat_values), buf, offset, *self.iat_values)
+        offset += len(self.iat_values) * 4
 
         for idt in self.idt:
-            new_data += struct.pack(idt.format, *[getattr(idt, f) for f in idt.fieldNames])
-        new_data += struct.pack('<%dB' % (struct.calcsize(self.idt[0].format)),
-                                *[0] * struct.calcsize(self.idt[0].format))
+            offset = idt.write_into(buf, offset)
+        offset += self.idt[0].size  # the null entry which terminates the table, buf is zero-filled
 
-        new_data += struct.pack('<%dI' % len(self.ilt_values), *self.ilt_values)
+        struct.pack_into('<%dI' % len(self.ilt_values), buf, offset, *self.ilt_values)
+        offset += len(self.ilt_values) * 4
 
-        new_data += struct.pack('<%ds' % len(self.hnt_values), self.hnt_values)
+        buf[offset:offset + len(self.hnt_values)] = self.hnt_values
+        offset += len(self.hnt_values)
 
-        assert len(new_data) == self.new_size
-        return new_data
+        assert offset - start == self.new_size
+        return offset
 
 
 if __name__ == '__main__':
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+import Events
+
+
+class SectionRaw:
+    """Represent a section nothing is known about (.tls, .pdata, UPX0...).
+
+    Its contents are a buffer over the image, so passing it through copies nothing until it is written."""
+
+    def __init__(self, filedata, fp, fsize, rva, vsize):
+        self.data = filedata
+        self.fp = fp
+        self.fsize = fsize
+        self.rva = rva
+        self.vsize = vsize
+        self.items = []
+        self.name = '?'
+
+        self.new_size = 0
+        self.new_rva = 0
+        self.new_vsize = 0
+        self.new_fp = 0
+        self.new_fsize = 0
+
+        self.size = min(fsize, vsize)
+        self.bias = self.rva - self.fp
+        self.dirty = False
+
+    def parse(self, oh=None):
+        self.items = buffer(self.data, self.fp, self.size)
+
+    def __str__(self):
+        s = 'Section %s, %d bytes from 0x%x, 0x%x\n' % (self.name, self.size, self.fp, self.rva)
+        return s
+
+    def calculate_new_size(self, file_alignment, section_alignment):
+        self.new_size = len(self.items)
+        if self.new_size == self.size:
+            self.new_fsize, self.new_vsize = self.fsize, self.vsize
+            if Events.active:
+                Events.emit('calculate_new_size', 'unchanged', '%s size unchanged. fsize=0x%x, vsize=0x%x', self.name,
+                            self.new_fsize, self.new_vsize, section=self.name, fsize=self.new_fsize, vsize=self.new_vsize)
+        else:
+            assert False, '%s size 0x%x -> 0x%x, not implemented yet' % (self.name, self.size, self.new_size)
+
+        assert self.new_fsize % file_alignment == 0
+
+    def relocate(self, new_fp, new_rva):
+        """根据new_rva, new_size, new_fp等信息，重写数据
+
+        Absolute pointers inside the section have already been fixed up by Fixup when the RVA changes."""
+        self.new_fp, self.new_rva = new_fp, new_rva
+        if (self.fp, self.rva) == (self.new_fp, self.new_rva):
+            if Events.active:
+                Events.emit('relocate', 'unchanged', '%s fp and rva unchanged. fp=0x%x, rva=0x%x', self.name, self.new_fp,
+                            self.new_rva, section=self.name, fp=self.new_fp, rva=self.new_rva)
+        elif Events.active:
+            Events.emit('relocate', 'moved', '%s fp 0x%x -> 0x%x, rva 0x%x -> 0x%x', self.name, self.fp, self.new_fp,
+                        self.rva, self.new_rva, section=self.name, fp=self.new_fp, rva=self.new_rva)
+
+    def write(self):
+        new_data = str(self.items)
+        assert len(new_data) == self.new_size
+        return new_data
+
+    def write_into(self, buf, offset):
+        assert len(self.items) == self.new_size
+        buf[offset:offset + self.new_size] = self.items
+        return offset + self.new_size
+
+
+if __name__ == '__main__':
+    import PE
+
+    pe = PE.PE('helloworld.exe', parse=False)
+
+    raw = SectionRaw(pe.data, 0x4200, 0x2200, 0x15000, 0x2089)
+    raw.parse()
+    print raw
+
+    old_data = raw.data[raw.fp:raw.fp + raw.size]
+    raw.calculate_new_size(0x200, 0x1000)
+    raw.relocate(0x4200, 0x15000)
+    new_data = raw.write()
+    print 'old=0x%x, new=0x%x' % (len(old_data), len(new_data))
+    assert old_data == new_data
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Map sections to the classes which handle them.
+
+A section is handled by the class registered for its name, or else by the class registered for the data directory
+starting at its RVA (packers rename sections, not data directories), or else by SectionRaw, which keeps it as it is.
+Handlers are registered as module names, a module holding the class of the same name, and are imported on first use,
+once per process.
+"""
+
+HANDLERS = {
+    '.text': 'SectionText',
+    '.rdata': 'SectionRdata',
+    '.data': 'SectionData',
+    '.edata': 'SectionEdata',
+    '.idata': 'SectionIdata',
+    '.rsrc': 'SectionRsrc',
+    '.reloc': 'SectionReloc',
+}
+
+# data directories by the name of their fields in the optional header. The import table is left out, SectionIdata
+# rewrites the whole section from the import tables and a section found this way may hold more than them
+ROLES = {
+    'ExportTable': 'SectionEdata',
+    'ResourceTable': 'SectionRsrc',
+    'BaseRelocationTable': 'SectionReloc',
+}
+
+PASSTHROUGH = 'SectionRaw'
+
+classes = {}
+
+
+def register(name, handler):
+    """Handle the sections called name with handler, a class or the name of the module holding the class."""
+    HANDLERS[name] = handler
+
+
+def register_role(role, handler):
+    """Handle the sections starting with the data directory role (e.g. 'ResourceTable') with handler."""
+    ROLES[role] = handler
+
+
+def get_class(handler):
+    if not isinstance(handler, basestring):
+        return handler
+    if handler not in classes:
+        classes[handler] = getattr(__import__(handler), handler)
+    return classes[handler]
+
+
+def get_role(sh, oh):
+    """Return the data directory which starts at the section, or None."""
+    for role in ROLES:
+        rva = getattr(oh, role + 'RVA', 0)
+        if rva and rva == sh.VirtualAddress:
+            return role
+    return None
+
+
+def get_handler(sh, oh):
+    """Return the class handling the section described by sh."""
+    if sh.Name in HANDLERS:
+        return get_class(HANDLERS[sh.Name])
+    role = get_role(sh, oh)
+    return get_class(ROLES[role] if role else PASSTHROUGH)
@@ -1,7 +1,12 @@
 # -*- coding: utf-8 -*-
+import array
 import struct
 
+from Exception import *
+from Consts import *
+
 import BasicHeader
+import Events
 
 
 tableString1 = '''
@@ -17,21 +22,69 @@ class BaseRelocationBlock(BasicHeader.HomoHeader):
     The import information begins with the import directory table, which describes the remainder of the import information. The import directory table contains address information that is used to resolve fixup references to the entry points within a DLL image. The import directory table consists of an array of import directory entries, one entry for each DLL to which the image refers. The last directory entry is empty (filled with null values), which indicates the end of the directory table.
     """
 
+    schema = BasicHeader.get_schema(format1, tableString1)
+    __slots__ = schema.names
+
     def parse(self, data, file_pointer):
         self.set_attributes_by_table(data, file_pointer, format1, tableString1)
         self.size = self.BlockSize
-        self.items = struct.unpack_from('<%dI' % (self.BlockSize / 4 - 2), data, file_pointer + 8)
+
+    @classmethod
+    def restore(cls, data, file_pointer, values, schemas=None):
+        self = super(BaseRelocationBlock, cls).restore(data, file_pointer, values)
+        self.size = self.BlockSize
+        return self
 
     def validate(self):
-        pass
+        if self.BlockSize < 8 or self.BlockSize % 4 != 0:
+            raise PEFormatError('Base Relocation Block at 0x%x has an invalid size %d' % (self.fp, self.BlockSize))
 
     def get_regions(self, pe):
         r = [(self.fp, self.BlockSize, 'Base Relocation Block for 0x%x' % self.PageRVA)]
         return r
 
 
+def build_columns(rvas, types=None):
+    """Build the relocation columns for a set of pointer locations.
+
+    Locations are sorted and grouped by 4K page, and a block with an odd number of entries is padded with an
+    IMAGE_REL_BASED_ABSOLUTE entry so that the next one starts on a 32-bit boundary.
+    Return (pages, types, offsets, block_starts) as SectionReloc stores them."""
+
+    if types is None:
+        entries = sorted(set(rvas))
+        types = [IMAGE_REL_BASED_HIGHLOW] * len(entries)
+    else:
+        entries, types = zip(*sorted(set(zip(rvas, types)))) or ((), ())
+
+    new_pages, new_types, new_offsets, block_starts = array.array('I'), array.array('B'), array.array('H'), array.array('I')
+
+    def pad(page):
+        if len(block_starts) and (len(new_types) - block_starts[-1]) % 2:
+            new_pages.append(page)
+            new_types.append(IMAGE_REL_BASED_ABSOLUTE)
+            new_offsets.append(0)
+
+    page = -1
+    for rva, t in zip(entries, types):
+        if rva & ~0xfff != page:
+            pad(page)
+            page = rva & ~0xfff
+            block_starts.append(len(new_types))
+        new_pages.append(page)
+        new_types.append(t)
+        new_offsets.append(rva & 0xfff)
+    pad(page)
+
+    return new_pages, new_types, new_offsets, block_starts
+
+
 class SectionReloc:
-    """Represent the .relo section."""
+    """Represent the .relo section.
+
+    The entries of all blocks are decoded into columns: pages, types and offsets hold the page RVA, the type and the
+    offset of every entry, and block_starts the index of the first entry of every block.
+    """
 
     def __init__(self, filedata, fp, fsize, rva, vsize):
         self.data = filedata
@@ -44,6 +97,11 @@ class SectionReloc:
         self.brt_size = 0
         self.brt_rva = 0
 
+        self.pages = array.array('I')
+        self.types = array.array('B')
+        self.offsets = array.array('H')
+        self.block_starts = array.array('I')
+
         self.new_size = 0
         self.new_rva = 0
         self.new_vsize = 0
@@ -52,6 +110,7 @@ class SectionReloc:
 
         self.size = min(fsize, vsize)
         self.bias = self.rva - self.fp
+        self.dirty = False
 
     def parse(self, oh):
         self.__parse__(oh.BaseRelocationTableRVA, oh.BaseRelocationTableSize)
@@ -59,20 +118,60 @@ class SectionReloc:
     def __parse__(self, brt_start_rva, brt_size):
         self.size = brt_size
         self.parse_brt(brt_start_rva, brt_size)
+        self.dirty = self.brt_fp != self.fp  # write() puts the table at the start of the section
 
     def parse_brt(self, brt_start_rva, brt_size):
         brt_start_fp = brt_start_rva - self.rva + self.fp
         brt_end_fp = brt_start_fp
+        words = array.array('H')
         while brt_end_fp < brt_start_fp + brt_size:
             header = BaseRelocationBlock(self.data, brt_end_fp)
+            self.block_starts.append(len(words))
+            self.pages.extend(array.array('I', [header.PageRVA]) * ((header.BlockSize - 8) / 2))
+            words.fromstring(self.data[brt_end_fp + 8:brt_end_fp + header.BlockSize])
             brt_end_fp += header.size
             self.brt.append(header)
         assert brt_end_fp == brt_start_fp + brt_size
 
+        self.types = array.array('B', [x >> 12 for x in words])
+        self.offsets = array.array('H', [x & 0xfff for x in words])
+
         self.brt_fp = brt_start_fp
         self.brt_size = brt_size
         self.brt_rva = self.brt_fp + self.bias
 
+    def get_locations(self):
+        """Return the RVAs and the types of all pointers to be fixed up, padding entries left out."""
+        rvas, types = array.array('I'), array.array('B')
+        for i, t in enumerate(self.types):
+            if t != IMAGE_REL_BASED_ABSOLUTE:
+                rvas.append(self.pages[i] + self.offsets[i])
+                types.append(t)
+        return rvas, types
+
+    def set_locations(self, rvas, types=None):
+        """Replace the relocation table by one built from pointer locations (IMAGE_REL_BASED_HIGHLOW by default)."""
+        self.pages, self.types, self.offsets, self.block_starts = build_columns(rvas, types)
+        self.dirty = True
+
+    def get_state(self):
+        """Return what parse() decoded, as plain values."""
+        return {
+            'brt': [(x.fp, x.get_values()) for x in self.brt],
+            'table': (self.size, self.brt_fp, self.brt_size),
+            'columns': [x.tostring() for x in (self.pages, self.types, self.offsets, self.block_starts)],
+            'dirty': self.dirty,
+        }
+
+    def set_state(self, state):
+        """Take the place of parse() with the values get_state() returned."""
+        self.brt = [BaseRelocationBlock.restore(self.data, fp, values) for fp, values in state['brt']]
+        self.size, self.brt_fp, self.brt_size = state['table']
+        self.brt_rva = self.brt_fp + self.bias
+        self.pages, self.types, self.offsets, self.block_starts = [
+            array.array(typecode, x) for typecode, x in zip('IBHI', state['columns'])]
+        self.dirty = state['dirty']
+
     def __str__(self):
         s = 'Section .reloc, %d bytes from 0x%x, 0x%x\n' % (self.size, self.fp, self.rva)
         for brb in self.brt:
@@ -80,38 +179,52 @@ class SectionReloc:
         return s
 
     def calculate_new_size(self, file_alignment, section_alignment):
-        """TODO:根据信息调整brt表项的大小"""
-
-        self.new_size = 0
-        for brb in self.brt:
-            brb.new_size = brb.size  # to be modified
-            self.new_size += brb.new_size
+        self.new_size = 8 * len(self.block_starts) + 2 * len(self.types)
 
         if self.new_size == self.size:
             self.new_fsize, self.new_vsize = self.fsize, self.vsize
-            print '.reloc size unchanged. fsize=0x%x, vsize=0x%x' % (self.new_fsize, self.new_vsize)
+            if Events.active:
+                Events.emit('calculate_new_size', 'unchanged', '.reloc size unchanged. fsize=0x%x, vsize=0x%x', self.new_fsize,
+                            self.new_vsize, section='.reloc', fsize=self.new_fsize, vsize=self.new_vsize)
         else:
-            assert False, '.reloc size 0x%x -> 0x%x, not implemented yet' % (self.size, self.new_size)
+            self.new_vsize = self.vsize + self.new_size - self.size
+            self.new_fsize = self.new_size + (file_alignment - self.new_size % file_alignment) % file_alignment
+            if Events.active:
+                Events.emit('calculate_new_size', 'resized', '.reloc size 0x%x -> 0x%x. fsize=0x%x, vsize=0x%x', self.size,
+                            self.new_size, self.new_fsize, self.new_vsize, section='.reloc', size=self.new_size,
+                            fsize=self.new_fsize, vsize=self.new_vsize)
 
         assert self.new_fsize % file_alignment == 0
 
     def relocate(self, new_fp, new_rva):
-        """根据new_rva, new_size, new_fp等信息，重写数据"""
+        """根据new_rva, new_size, new_fp等信息，重写数据
+
+        Absolute pointers inside the section have already been fixed up by Fixup when the RVA changes."""
         self.new_fp, self.new_rva = new_fp, new_rva
-        if (self.fp, self.fsize, self.rva, self.vsize) == (self.new_fp, self.new_fsize, self.new_rva, self.new_vsize):
-            print '.reloc fp and rva unchanged. fp=0x%x, rva=0x%x' % (self.new_fp, self.new_rva)
-        else:
-            assert False, '.reloc fp 0x%x -> 0x%x, rva 0x%x -> 0x%x, not implemented yet' % (
-                self.fp, self.new_fp, self.rva, self.new_rva)
+        if (self.fp, self.rva) == (self.new_fp, self.new_rva):
+            if Events.active:
+                Events.emit('relocate', 'unchanged', '.reloc fp and rva unchanged. fp=0x%x, rva=0x%x', self.new_fp, self.new_rva,
+                            section='.reloc', fp=self.new_fp, rva=self.new_rva)
+        elif Events.active:
+            Events.emit('relocate', 'moved', '.reloc fp 0x%x -> 0x%x, rva 0x%x -> 0x%x', self.fp, self.new_fp, self.rva,
+                        self.new_rva, section='.reloc', fp=self.new_fp, rva=self.new_rva)
 
     def write(self):
-        new_data = ''
-        for brb in self.brt:
-            new_data += struct.pack(brb.format, *[getattr(brb, x) for x in brb.fieldNames])
-            new_data += struct.pack('<%dI' % (brb.size / 4 - 2), *brb.items)
-
-        assert len(new_data) == self.new_size
-        return new_data
+        new_data = bytearray(self.new_size)
+        self.write_into(new_data, 0)
+        return str(new_data)
+
+    def write_into(self, buf, offset):
+        start = offset
+        ends = self.block_starts[1:] + array.array('I', [len(self.types)])
+        for first, last in zip(self.block_starts, ends):
+            struct.pack_into('<2I', buf, offset, self.pages[first], 8 + 2 * (last - first))
+            words = array.array('H', [(t << 12) | o for t, o in zip(self.types[first:last], self.offsets[first:last])])
+            buf[offset + 8:offset + 8 + 2 * (last - first)] = words.tostring()
+            offset += 8 + 2 * (last - first)
+
+        assert offset - start == self.new_size
+        return offset
 
 
 if __name__ == '__main__':
@@ -1,8 +1,110 @@
 # -*- coding: utf-8 -*-
+import array
+import struct
+
+from Exception import *
+
+import BasicHeader
+import Events
+import Fixup
+
+
+tableString1 = '''
+    0	4	Characteristics	Resource flags. This field is reserved for future use. It is currently set to zero.
+    4	4	Time/Date Stamp	The time that the resource data was created by the resource compiler.
+    8	2	Major Version	The major version number, set by the user.
+  10	2	Minor Version	The minor version number, set by the user.
+  12	2	Number of Name Entries	The number of directory entries immediately following the table that use strings to identify Type, Name, or Language entries (depending on the level of the table).
+  14	2	Number of ID Entries	The number of directory entries immediately following the Name entries that use numeric IDs for Type, Name, or Language entries.
+'''
+format1 = '2I 4H'
+
+tableString2 = '''
+    0	4	Data RVA	The address of a unit of resource data in the Resource Data area.
+    4	4	Size	The size, in bytes, of the resource data that is pointed to by the Data RVA field.
+    8	4	Codepage	The code page that is used to decode code point values within the resource data. Typically, the code page would be the Unicode code page.
+  12	4	Reserved	Reserved, must be 0.
+'''
+format2 = '4I'
+
+
+class ResourceDirectoryTable(BasicHeader.HomoHeader):
+    """Represent the Resource Directory Table.
+
+    Each resource directory table has the following format. This data structure should be considered the heading of a table because the table actually consists of directory entries and this structure.
+    """
+
+    schema = BasicHeader.get_schema(format1, tableString1)
+    __slots__ = schema.names
+
+    def parse(self, data, file_pointer):
+        self.set_attributes_by_table(data, file_pointer, format1, tableString1)
+
+
+class ResourceDataEntry(BasicHeader.HomoHeader):
+    """Represent the Resource Data Entry.
+
+    The Resource Data Entry describes the actual unit of raw data in the Resource Data area.
+    """
+
+    schema = BasicHeader.get_schema(format2, tableString2)
+    __slots__ = schema.names
+
+    def parse(self, data, file_pointer):
+        self.set_attributes_by_table(data, file_pointer, format2, tableString2)
+
+
+class ResourceDirectory:
+    """A directory of the resource tree, whose entries are decoded on first access.
+
+    Entries are keyed by ID, or by name (unicode) for named entries. Looking an entry up gives the ResourceDirectory
+    or the ResourceDataEntry it points to, built on first access too.
+    """
+
+    def __init__(self, rsrc, offset):
+        self.rsrc = rsrc
+        self.offset = offset
+        self.table = ResourceDirectoryTable(rsrc.data, rsrc.get_fp(offset, 16))
+        self.entries = None
+        self.children = {}
+
+    def get_entries(self):
+        """Return {key: offset of what the entry points to, with the high bit set for a subdirectory}."""
+        if self.entries is None:
+            n = self.table.NumberofNameEntries + self.table.NumberofIDEntries
+            fp = self.rsrc.get_fp(self.offset + self.table.size, n * 8)
+            # pairs of (name offset or ID, data entry or subdirectory offset), decoded at once
+            words = array.array('I', self.rsrc.data[fp:fp + n * 8])
+            self.entries = {}
+            for i in xrange(0, n * 2, 2):
+                key = int(words[i])
+                if key >> 31:
+                    key = self.rsrc.get_name(key & 0x7fffffff)
+                self.entries[key] = int(words[i + 1])
+        return self.entries
+
+    def keys(self):
+        return self.get_entries().keys()
+
+    def __contains__(self, key):
+        return key in self.get_entries()
+
+    def __getitem__(self, key):
+        if key not in self.children:
+            offset = self.get_entries()[key]
+            if offset >> 31:
+                self.children[key] = ResourceDirectory(self.rsrc, offset & 0x7fffffff)
+            else:
+                self.children[key] = ResourceDataEntry(self.rsrc.data, self.rsrc.get_fp(offset, 16))
+        return self.children[key]
 
 
 class SectionRsrc:
-    """Represent the .rsrc section."""
+    """Represent the .rsrc section.
+
+    The resource tree (type, then name or ID, then language) is walked lazily, from get_root() or find(). The data
+    of a resource is returned as a buffer over the image, which is valid until the PE is closed.
+    """
 
     def __init__(self, filedata, fp, fsize, rva, vsize):
         self.data = filedata
@@ -20,9 +122,62 @@ class SectionRsrc:
 
         self.size = min(fsize, vsize)
         self.bias = self.rva - self.fp
+        self.dirty = False
+
+        self.root_fp = self.fp
+        self.root = None
+        self.index = None
 
     def parse(self, oh=None):
-        self.items = self.data[self.fp:self.fp + self.size]
+        if oh is not None and 0 <= oh.ResourceTableRVA - self.rva < self.size:
+            self.root_fp = oh.ResourceTableRVA - self.rva + self.fp
+        self.items = buffer(self.data, self.fp, self.size)
+
+    def get_fp(self, offset, size):
+        """Return the file pointer of size bytes at offset from the resource root, which must be in the section."""
+        fp = self.root_fp + offset
+        if fp + size > self.fp + self.size:
+            raise PEFormatError('Resource structure at offset 0x%x runs past the end of .rsrc' % offset)
+        return fp
+
+    def get_name(self, offset):
+        length, = struct.unpack_from('<H', self.data, self.get_fp(offset, 2))
+        fp = self.get_fp(offset + 2, length * 2)
+        return self.data[fp:fp + length * 2].decode('utf-16-le')
+
+    def get_root(self):
+        if self.root is None:
+            self.root = ResourceDirectory(self, 0)
+        return self.root
+
+    def find(self, type=None, name=None, language=None):
+        """Return [((type, name, language), ResourceDataEntry)] for the resources matching the keys given.
+
+        None matches any key. Only the directories on the way to the matches are walked."""
+        level = [((), self.get_root())]
+        for key in (type, name, language):
+            found = []
+            for path, directory in level:
+                if not isinstance(directory, ResourceDirectory):
+                    continue
+                for k in ([key] if key is not None else sorted(directory.keys())):
+                    if k in directory:
+                        found.append((path + (k,), directory[k]))
+            level = found
+        return [(path, entry) for path, entry in level if isinstance(entry, ResourceDataEntry)]
+
+    def get_index(self):
+        """Return {(type, name, language): ResourceDataEntry} for every resource, walking the whole tree once."""
+        if self.index is None:
+            self.index = dict(self.find())
+        return self.index
+
+    def get_data(self, entry):
+        """Return the data of a resource, as a buffer over the image."""
+        offset = entry.DataRVA - self.rva
+        if not 0 <= offset <= self.size - entry.Size:
+            raise PEFormatError('Resource data at 0x%x (0x%x bytes) is not in .rsrc' % (entry.DataRVA, entry.Size))
+        return buffer(self.data, self.fp + offset, entry.Size)
 
     def __str__(self):
         s = 'Section .rsrc, %d bytes from 0x%x, 0x%x\n' % (self.size, self.fp, self.rva)
@@ -34,7 +189,9 @@ class SectionRsrc:
         self.new_size = len(self.items)
         if self.new_size == self.size:
             self.new_fsize, self.new_vsize = self.fsize, self.vsize
-            print '.rsrc size unchanged. fsize=0x%x, vsize=0x%x' % (self.new_fsize, self.new_vsize)
+            if Events.active:
+                Events.emit('calculate_new_size', 'unchanged', '.rsrc size unchanged. fsize=0x%x, vsize=0x%x', self.new_fsize,
+                            self.new_vsize, section='.rsrc', fsize=self.new_fsize, vsize=self.new_vsize)
         else:
             assert False, '.rsrc size 0x%x -> 0x%x, not implemented yet' % (self.size, self.new_size)
 
@@ -43,17 +200,35 @@ class SectionRsrc:
     def relocate(self, new_fp, new_rva):
         """根据new_rva, new_size, new_fp等信息，重写数据"""
         self.new_fp, self.new_rva = new_fp, new_rva
-        if (self.fp, self.fsize, self.rva, self.vsize) == (self.new_fp, self.new_fsize, self.new_rva, self.new_vsize):
-            print '.rsrc fp and rva unchanged. fp=0x%x, rva=0x%x' % (self.new_fp, self.new_rva)
+        if (self.fp, self.rva) == (self.new_fp, self.new_rva):
+            if Events.active:
+                Events.emit('relocate', 'unchanged', '.rsrc fp and rva unchanged. fp=0x%x, rva=0x%x', self.new_fp, self.new_rva,
+                            section='.rsrc', fp=self.new_fp, rva=self.new_rva)
+        elif self.rva == self.new_rva:
+            if Events.active:
+                Events.emit('relocate', 'moved', '.rsrc fp 0x%x -> 0x%x', self.fp, self.new_fp, section='.rsrc',
+                            fp=self.new_fp, rva=self.new_rva)
         else:
-            assert False, '.rsrc fp 0x%x -> 0x%x, rva 0x%x -> 0x%x, not implemented yet' % (
-                self.fp, self.new_fp, self.rva, self.new_rva)
+            # the resource data entries hold RVAs into the section, move them along
+            delta = self.new_rva - self.rva
+            items = Fixup.materialize(self)
+            for path, entry in self.get_index().items():
+                if 0 <= entry.DataRVA - self.rva < self.vsize:
+                    struct.pack_into('<I', items, entry.fp - self.fp, entry.DataRVA + delta)
+            if Events.active:
+                Events.emit('relocate', 'moved', '.rsrc fp 0x%x -> 0x%x, rva 0x%x -> 0x%x', self.fp, self.new_fp, self.rva,
+                            self.new_rva, section='.rsrc', fp=self.new_fp, rva=self.new_rva)
 
     def write(self):
         new_data = self.items
         assert len(new_data) == self.new_size
         return new_data
 
+    def write_into(self, buf, offset):
+        assert len(self.items) == self.new_size
+        buf[offset:offset + self.new_size] = self.items
+        return offset + self.new_size
+
 
 if __name__ == '__main__':
     import PE
@@ -63,6 +238,8 @@ if __name__ == '__main__':
     rsrc = SectionRsrc(pe.data, 0x7000, 0x600, 0x1a000, 0x43c)
     rsrc.parse()
     print rsrc
+    for path, entry in rsrc.find():
+        print path, len(rsrc.get_data(entry))
 
     old_data = rsrc.data[rsrc.fp:rsrc.fp + rsrc.size]
     rsrc.calculate_new_size(0x200, 0x1000)
@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import Events
+import X86Length
 
 
 class SectionText:
@@ -11,6 +13,8 @@ class SectionText:
         self.rva = rva
         self.vsize = vsize
         self.insts = []
+        self.entries = []
+        self.instructions = None
 
         self.new_size = 0
         self.new_rva = 0
@@ -20,13 +24,23 @@ class SectionText:
 
         self.size = min(fsize, vsize)
         self.bias = self.rva - self.fp
+        self.dirty = False
 
     def parse(self, oh=None):
+        if oh is not None and 0 <= oh.AddressOfEntryPoint - self.rva < self.size:
+            self.entries = [oh.AddressOfEntryPoint - self.rva]
         self.disassemble()
 
     def disassemble(self):
-        self.insts = self.data[self.fp:self.fp + self.size]
-        pass
+        self.insts = buffer(self.data, self.fp, self.size)
+        self.instructions = None
+
+    def get_instructions(self, functions=()):
+        """Return the X86Length.Instructions of the section, found by a linear sweep from its start, the entry point
+        and the given function starts (offsets in the section)."""
+        if self.instructions is None or functions:
+            self.instructions = X86Length.sweep(self.insts, [0] + self.entries + list(functions))
+        return self.instructions
 
     def __str__(self):
         s = 'Section .text, %d bytes from 0x%x, 0x%x\n' % (self.size, self.fp, self.rva)
@@ -38,26 +52,37 @@ class SectionText:
         self.new_size = len(self.insts)
         if self.new_size == self.size:
             self.new_fsize, self.new_vsize = self.fsize, self.vsize
-            print '.text size unchanged. fsize=0x%x, vsize=0x%x' % (self.new_fsize, self.new_vsize)
+            if Events.active:
+                Events.emit('calculate_new_size', 'unchanged', '.text size unchanged. fsize=0x%x, vsize=0x%x', self.new_fsize,
+                            self.new_vsize, section='.text', fsize=self.new_fsize, vsize=self.new_vsize)
         else:
             assert False, '.text size 0x%x -> 0x%x, not implemented yet' % (self.size, self.new_size)
 
         assert self.new_fsize % file_alignment == 0, 'Raw size 0x%x' % self.new_fsize
 
     def relocate(self, new_fp, new_rva):
-        """根据new_rva, new_size, new_fp等信息，重写数据"""
+        """根据new_rva, new_size, new_fp等信息，重写数据
+
+        Absolute pointers inside the section have already been fixed up by Fixup when the RVA changes."""
         self.new_fp, self.new_rva = new_fp, new_rva
-        if (self.fp, self.fsize, self.rva, self.vsize) == (self.new_fp, self.new_fsize, self.new_rva, self.new_vsize):
-            print '.text fp and rva unchanged. fp=0x%x, rva=0x%x' % (self.new_fp, self.new_rva)
-        else:
-            assert False, '.text fp 0x%x -> 0x%x, rva 0x%x -> 0x%x, not implemented yet' % (
-                self.fp, self.new_fp, self.rva, self.new_rva)
+        if (self.fp, self.rva) == (self.new_fp, self.new_rva):
+            if Events.active:
+                Events.emit('relocate', 'unchanged', '.text fp and rva unchanged. fp=0x%x, rva=0x%x', self.new_fp, self.new_rva,
+                            section='.text', fp=self.new_fp, rva=self.new_rva)
+        elif Events.active:
+            Events.emit('relocate', 'moved', '.text fp 0x%x -> 0x%x, rva 0x%x -> 0x%x', self.fp, self.new_fp, self.rva,
+                        self.new_rva, section='.text', fp=self.new_fp, rva=self.new_rva)
 
     def write(self):
         new_data = self.insts
         assert len(new_data) == self.new_size
         return new_data
 
+    def write_into(self, buf, offset):
+        assert len(self.insts) == self.new_size
+        buf[offset:offset + self.new_size] = self.insts
+        return offset + self.new_size
+
 
 if __name__ == '__main__':
     import PE
@@ -67,6 +92,7 @@ if __name__ == '__main__':
     text = SectionText(pe.data, 0x400, 0x3e00, 0x11000, 0x3c26)
     text.parse()
     print text
+    print text.get_instructions()
 
     old_data = text.data[text.fp:text.fp + text.size]
     text.calculate_new_size(0x200, 0x1000)
@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+import sys
+import random
+import struct
+
+from Consts import *
+
+import BasicHeader
+import Checksum
+import COFFFileHeader
+import OptionalHeader
+import SectionHeader
+import SectionEdata
+import SectionIdata
+import SectionReloc
+
+
+FILE_ALIGNMENT = 0x200
+SECTION_ALIGNMENT = 0x1000
+IMAGE_BASE = 0x400000
+PE_SIGNATURE_FP = 0x80
+
+# names PE.parse knows how to handle, in the order they are generated
+PASSTHROUGH_NAMES = ['.text', '.rdata', '.data']
+
+CHARACTERISTICS = {
+    '.text': 0x60000020,  # code, execute, read
+    '.rdata': 0x40000040,  # initialized data, read
+    '.edata': 0x40000040,  # initialized data, read
+    '.idata': 0xc0000040,  # initialized data, read, write
+    '.reloc': 0x42000040,  # initialized data, discardable, read
+}
+DATA_CHARACTERISTICS = 0xc0000040  # initialized data, read, write
+
+
+def align(value, alignment):
+    return value + (alignment - value % alignment) % alignment
+
+
+def pack_schema(buf, offset, schema, **fields):
+    """Pack the fields of a header schema at offset, the fields not given are zero."""
+    values = [fields.pop(name, 0) for name in schema.names]
+    assert not fields, 'unknown fields %s' % fields.keys()
+    schema.struct.pack_into(buf, offset + schema.offsets[0], *values)
+
+
+def build_edata(rva, exports, code_rva, code_size):
+    """Build an export section: the export directory, the address, name pointer and ordinal tables, then the names.
+
+    Export i is named 'Export%06d' (so the names are sorted) and points 16 * i bytes (wrapping around) into the code_size
+    bytes of code at code_rva."""
+    eat_offset = 40
+    npt_offset = eat_offset + exports * 4
+    ot_offset = npt_offset + exports * 4
+    names_offset = ot_offset + exports * 2
+
+    names = bytearray('SYNTHETIC.dll\x00')
+    pointers = []
+    for i in xrange(exports):
+        pointers.append(rva + names_offset + len(names))
+        names += 'Export%06d\x00' % i
+
+    data = bytearray(names_offset + len(names))
+    data[eat_offset:npt_offset] = struct.pack('<%dI' % exports, *[code_rva + 16 * i % code_size for i in xrange(exports)])
+    data[npt_offset:ot_offset] = struct.pack('<%dI' % exports, *pointers)
+    data[ot_offset:names_offset] = struct.pack('<%dH' % exports, *range(exports))
+    data[names_offset:] = names
+
+    pack_schema(data, 0, BasicHeader.get_schema(SectionEdata.format1, SectionEdata.tableString1),
+                NameRVA=rva + names_offset, OrdinalBase=1, AddressTableEntries=exports, NumberofNamePointers=exports,
+                ExportAddressTableRVA=rva + eat_offset, NamePointerRVA=rva + npt_offset,
+                OrdinalTableRVA=rva + ot_offset)
+    return data, (rva, len(data))
+
+
+def build_idata(rva, dlls, functions):
+    """Build an import section in the order SectionIdata writes it: IAT, IDT, ILT, then the hint/name table."""
+    entries = functions + 1  # with the null terminator
+    iat_size = dlls * entries * 4
+    idt_size = (dlls + 1) * 20
+    ilt_offset = iat_size + idt_size
+    hnt_offset = ilt_offset + iat_size
+
+    hnt = bytearray()
+    thunks, names = [], []
+    for d in xrange(dlls):
+        names.append(hnt_offset + len(hnt))
+        hnt += 'DLL%03d.dll\x00' % d
+        if len(hnt) % 2:
+            hnt += '\x00'
+        for f in xrange(functions):
+            thunks.append(hnt_offset + len(hnt) + rva)
+            hnt += struct.pack('<H', f) + 'Function%05d\x00' % f
+            if len(hnt) % 2:
+                hnt += '\x00'
+        thunks.append(0)
+
+    data = bytearray(hnt_offset + len(hnt))
+    thunks = struct.pack('<%dI' % len(thunks), *thunks)
+    data[0:iat_size] = thunks
+    data[ilt_offset:ilt_offset + iat_size] = thunks
+    data[hnt_offset:] = hnt
+
+    schema = BasicHeader.get_schema(SectionIdata.format1, SectionIdata.tableString1)
+    for d in xrange(dlls):
+        pack_schema(data, iat_size + d * 20, schema,
+                    ImportLookupTableRVA=rva + ilt_offset + d * entries * 4,
+                    NameRVA=rva + names[d],
+                    ImportAddressTableRVA=rva + d * entries * 4)
+    return data, (rva + iat_size, idt_size), (rva, iat_size)
+
+
+def generate(sections=1, section_size=0x1000, dlls=1, functions=1, reloc_density=0.01, overlay=0, seed=0, exports=0):
+    """Return a valid PE32 image as a bytearray.
+
+    sections passthrough sections of section_size bytes each (.text first), an .edata section exporting exports
+    functions of .text (none if exports is 0, the image is then an EXE rather than a DLL), an .idata section importing
+    functions functions from each of dlls DLLs, a .reloc section with a fixup every 1/reloc_density pointer-sized
+    slots of .text (none if reloc_density or sections is 0), and overlay bytes after the last section.
+    """
+
+    rng = random.Random(seed)
+    names = PASSTHROUGH_NAMES[:sections] + ['.data%d' % i for i in xrange(1, sections - len(PASSTHROUGH_NAMES) + 1)]
+    if exports and sections:
+        names.append('.edata')
+    if dlls:
+        names.append('.idata')
+    if reloc_density and sections:
+        names.append('.reloc')
+
+    # at least 0x400 bytes of headers, as the Microsoft linker emits
+    headers_size = max(0x400, align(PE_SIGNATURE_FP + 4 + 20 + 224 + 40 * len(names), FILE_ALIGNMENT))
+
+    # the virtual layout, section after section: the contents of .edata, .idata and .reloc depend on their own RVA
+    # and the RVA of .text, which comes first
+    text_rva = align(headers_size, SECTION_ALIGNMENT)
+    fixups = []
+    contents = {}
+    directories = {}
+    layout, rva = [], text_rva
+    for name in names:
+        if name == '.edata':
+            contents[name], directories['Export Table'] = build_edata(rva, exports, text_rva, section_size)
+        elif name == '.idata':
+            contents[name], directories['Import Table'], directories['IAT'] = build_idata(rva, dlls, functions)
+        elif name == '.reloc':
+            step = max(4, int(4 / reloc_density) & ~3)
+            fixups = range(0, section_size - 3, step)
+            reloc = SectionReloc.SectionReloc('', 0, 0, 0, 0)
+            reloc.set_locations([text_rva + x for x in fixups])
+            reloc.new_size = 8 * len(reloc.block_starts) + 2 * len(reloc.types)
+            contents[name] = reloc.write()
+            directories['Base Relocation Table'] = (rva, len(contents[name]))
+        size = len(contents[name]) if name in contents else section_size
+        layout.append([name, rva, size])
+        rva += align(size, SECTION_ALIGNMENT)
+
+    # a pseudo random block repeated over every passthrough section keeps generation fast at any size
+    block = bytearray(rng.getrandbits(8) for i in xrange(4096))
+
+    size_of_image = layout[-1][1] + align(layout[-1][2], SECTION_ALIGNMENT) if layout else SECTION_ALIGNMENT
+    fp = headers_size
+    for entry in layout:
+        entry.append(fp)
+        fp += align(entry[2], FILE_ALIGNMENT)
+
+    data = bytearray(fp + overlay)
+    data[0:2] = 'MZ'
+    struct.pack_into('<I', data, FILE_OFFSET_TO_PE_SIGNATURE, PE_SIGNATURE_FP)
+    data[PE_SIGNATURE_FP:PE_SIGNATURE_FP + 4] = 'PE\x00\x00'
+
+    fp = PE_SIGNATURE_FP + 4
+    pack_schema(data, fp, BasicHeader.get_schema(COFFFileHeader.format1, COFFFileHeader.tableString1),
+                Machine=0x14c, NumberOfSections=len(names), SizeOfOptionalHeader=224,
+                Characteristics=0x2102 if '.edata' in names else 0x0102)
+
+    fp += 20
+    pack_schema(data, fp, BasicHeader.get_schema(OptionalHeader.format1, OptionalHeader.tableString1),
+                Magic=PE32_MAGIC_NUMBER, MajorLinkerVersion=9,
+                SizeOfCode=align(section_size, FILE_ALIGNMENT) if sections else 0,
+                AddressOfEntryPoint=text_rva if sections else 0, BaseOfCode=text_rva if sections else 0)
+    pack_schema(data, fp, BasicHeader.get_schema(OptionalHeader.format2, OptionalHeader.tableString2),
+                BaseOfData=layout[1][1] if len(layout) > 1 else 0)
+    pack_schema(data, fp, BasicHeader.get_schema(OptionalHeader.format3, OptionalHeader.tableString3),
+                ImageBase=IMAGE_BASE, SectionAlignment=SECTION_ALIGNMENT, FileAlignment=FILE_ALIGNMENT,
+                MajorOperatingSystemVersion=5, MajorSubsystemVersion=5, SizeOfImage=size_of_image,
+                SizeOfHeaders=headers_size, Subsystem=3, SizeOfStackReserve=0x100000, SizeOfStackCommit=0x1000,
+                SizeOfHeapReserve=0x100000, SizeOfHeapCommit=0x1000, NumberOfRvaAndSizes=16)
+    fields = {}
+    for name, (rva, size) in directories.items():
+        fields[name.replace(' ', '') + 'RVA'], fields[name.replace(' ', '') + 'Size'] = rva, size
+    pack_schema(data, fp, OptionalHeader.get_data_directory_schema(96, 16), **fields)
+
+    fp += 224
+    schema = BasicHeader.get_schema(SectionHeader.format1, SectionHeader.tableString1)
+    for name, rva, vsize, raw in layout:
+        pack_schema(data, fp, schema, Name=name, VirtualSize=vsize, VirtualAddress=rva,
+                    SizeOfRawData=align(vsize, FILE_ALIGNMENT), PointerToRawData=raw,
+                    Characteristics=CHARACTERISTICS.get(name, DATA_CHARACTERISTICS))
+        fp += 40
+
+        if name in contents:
+            data[raw:raw + vsize] = contents[name]
+        else:
+            for offset in xrange(raw, raw + vsize, len(block)):
+                data[offset:min(offset + len(block), raw + vsize)] = block[:raw + vsize - offset]
+
+    # every fixed up pointer in .text points somewhere into the image
+    text_raw = layout[0][3] if sections else 0
+    for x in fixups:
+        struct.pack_into('<I', data, text_raw + x, IMAGE_BASE + rng.randrange(text_rva, size_of_image))
+
+    for offset in xrange(len(data) - overlay, len(data), len(block)):
+        data[offset:offset + len(block)] = block[:len(data) - offset]
+
+    checksum_fp = PE_SIGNATURE_FP + 4 + 20 + OPTIONAL_HEADER_OFFSET_TO_CHECKSUM
+    struct.pack_into('<I', data, checksum_fp, Checksum.compute(data, checksum_fp))
+    return data
+
+
+def check(data):
+    """Parse and rewrite an image, and check that it comes out the same, but for its CheckSum and the overlay."""
+    import PE
+
+    pe = PE.PE(str(data))
+    pe.calculate_new_size()
+    pe.calculate_new_address()
+    pe.relocate()
+    new_data = pe.build()
+
+    end = max([sh.PointerToRawData + sh.SizeOfRawData for sh in pe.sh] + [pe.oh.SizeOfHeaders])
+    checksum_fp = pe.oh.fp + OPTIONAL_HEADER_OFFSET_TO_CHECKSUM
+    assert new_data[:checksum_fp] == data[:checksum_fp]
+    assert new_data[checksum_fp + 4:end] == data[checksum_fp + 4:end]
+    assert Checksum.compute(new_data, checksum_fp) == pe.oh.CheckSum
+
+
+def get_pointers(pe):
+    """Return {location RVA: RVA pointed to} for every base relocation of pe."""
+    rvas = pe.get_reloc().get_locations()[0]
+    return dict([(x, struct.unpack_from('<I', pe.data, pe.rva2fp(x))[0] - pe.oh.ImageBase) for x in rvas])
+
+
+def check_moved(old, new):
+    """Check that new is old with its sections moved: every relocated pointer, import and export has moved by the
+    delta of the section it is in or points into, and the CheckSum of new is right."""
+    import bisect
+
+    layout = sorted([(sh.VirtualAddress, sh.Name) for sh in old.sh])
+    starts = [x[0] for x in layout]
+    new_rvas = dict([(sh.Name, sh.VirtualAddress) for sh in new.sh])
+
+    def move(rva):
+        va, name = layout[bisect.bisect_right(starts, rva) - 1]
+        return rva + new_rvas[name] - va
+
+    pointers = get_pointers(new)
+    assert sorted(pointers) == sorted([move(x) for x in get_pointers(old)])
+    for location, target in get_pointers(old).items():
+        assert pointers[move(location)] == move(target), hex(location)
+
+    old_imports, new_imports = old.get_imports(), new.get_imports()
+    assert old_imports.order == new_imports.order
+    for dll in old_imports.order:
+        assert [(symbol, hint, move(iat_rva)) for symbol, hint, iat_rva in old_imports.dlls[dll]] == new_imports.dlls[dll]
+
+    old_exports, new_exports = old.get_exports(), new.get_exports()
+    assert old_exports.get_dll_name() == new_exports.get_dll_name()
+    for i in xrange(len(old_exports.name_rvas)):
+        name = old_exports.get_name(i)
+        assert new_exports.find(name) == move(old_exports.find(name)), name
+
+    assert new.get_checksum() == new.oh.CheckSum
+
+
+def check_insert_remove(data, position):
+    """Insert a section before the position-th one of an image, write it, then remove the section again, checking
+    the layout moved each time."""
+    import os
+    import tempfile
+    import PE
+    import SectionHeader
+
+    directory = tempfile.mkdtemp()
+    opened = []
+
+    def load(path):
+        opened.append(PE.PE(path))
+        return opened[-1]
+
+    try:
+        paths = [os.path.join(directory, x) for x in ['source.exe', 'inserted.exe', 'removed.exe']]
+        with open(paths[0], 'wb') as f:
+            f.write(data)
+
+        pe = load(paths[0])
+        pe.calculate_new_size()
+        pe.insert_section(SectionHeader.make_sh('.new', 0x1800, DATA_CHARACTERISTICS), position, 'new' * 0x800)
+        pe.relocate()
+        pe.write(paths[1])
+        check_moved(load(paths[0]), load(paths[1]))
+
+        pe = load(paths[1])
+        pe.calculate_new_size()
+        pe.remove_section('.new')
+        pe.relocate()
+        pe.write(paths[2])
+        removed = load(paths[2])
+        check_moved(load(paths[1]), removed)
+        assert [sh.get_values() for sh in removed.sh] == [sh.get_values() for sh in load(paths[0]).sh]
+    finally:
+        for x in opened:
+            x.close()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def rename_section(data, name, new_name):
+    """Rename a section of an image in place, so that it is handled by the registry role of its data, if any."""
+    i = str(data).index(name.ljust(8, '\x00'))
+    data[i:i + 8] = new_name.ljust(8, '\x00')
+    return data
+
+
+def self_test():
+    import Events
+
+    Events.set_verbose(False)
+    for options in [{}, {'sections': 0}, {'sections': 0, 'exports': 10}, {'reloc_density': 0},
+                    {'sections': 5, 'exports': 100, 'dlls': 3, 'functions': 20, 'reloc_density': 0.1, 'overlay': 100}]:
+        check(generate(**options))
+        print 'ok', options
+
+    # sections actually move: the fix-ups, .idata, the export tables, and imports outside .idata
+    options = {'sections': 3, 'exports': 50, 'dlls': 3, 'functions': 10, 'reloc_density': 0.1}
+    for position in [1, 3]:
+        check_insert_remove(generate(**options), position)
+        print 'ok insert at %d and remove' % position, options
+    check_insert_remove(rename_section(generate(**options), '.idata', '.imp'), 1)
+    print 'ok insert and remove, with the imports in .imp', options
+
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generate a synthetic PE32 image.')
+    parser.add_argument('output', nargs='?', help='where to write the image')
+    parser.add_argument('--self-test', action='store_true', help='check that generated images round-trip, and exit')
+    parser.add_argument('--sections', type=int, default=1, help='number of passthrough sections, .text first')
+    parser.add_argument('--section-size', type=lambda x: int(x, 0), default=0x1000, help='bytes per section')
+    parser.add_argument('--exports', type=int, default=0, help='number of exported functions (0 for an EXE)')
+    parser.add_argument('--dlls', type=int, default=1, help='number of imported DLLs (0 for no .idata)')
+    parser.add_argument('--functions', type=int, default=1, help='number of functions imported from each DLL')
+    parser.add_argument('--reloc-density', type=float, default=0.01,
+                        help='fraction of pointer-sized slots of .text with a fixup (0 for no .reloc)')
+    parser.add_argument('--overlay', type=lambda x: int(x, 0), default=0, help='bytes appended after the sections')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    if args.self_test:
+        self_test()
+        return 0
+    if args.output is None:
+        parser.error('an output file is required')
+
+    data = generate(args.sections, args.section_size, args.dlls, args.functions, args.reloc_density, args.overlay,
+                    args.seed, args.exports)
+    with open(args.output, 'wb') as f:
+        f.write(data)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
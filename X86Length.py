@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+import array
+import bisect
+import operator
+
+
+# flags of the opcode tables, the low 3 bits are the size of the fixed immediate
+MODRM = 0x08  # followed by a ModRM byte (and maybe SIB and displacement)
+IMMZ = 0x10  # followed by an immediate of the operand size (4, or 2 with a 0x66 prefix)
+PREFIX = 0x20
+ESCAPE = 0x40  # 0x0f, look the next byte up in the two-byte table
+SPECIAL = 0x80  # the length depends on more than the opcode, see decode()
+INVALID = 0x100
+
+MAX_LENGTH = 15
+
+
+def build_one_byte_table():
+    t = [0] * 256
+    for row in xrange(0, 0x40, 8):
+        t[row:row + 6] = [MODRM, MODRM, MODRM, MODRM, 1, IMMZ]  # add/or/adc/sbb/and/sub/xor/cmp
+    for op in [0x26, 0x2e, 0x36, 0x3e, 0x64, 0x65, 0x66, 0x67, 0xf0, 0xf2, 0xf3]:
+        t[op] = PREFIX
+    t[0x0f] = ESCAPE
+    t[0x62] = t[0x63] = MODRM  # bound, arpl
+    t[0x68], t[0x69], t[0x6a], t[0x6b] = IMMZ, MODRM | IMMZ, 1, MODRM | 1
+    t[0x70:0x80] = [1] * 16  # jcc rel8
+    t[0x80], t[0x81], t[0x82], t[0x83] = MODRM | 1, MODRM | IMMZ, MODRM | 1, MODRM | 1
+    t[0x84:0x90] = [MODRM] * 12
+    t[0x9a] = SPECIAL  # call far ptr16:32
+    t[0xa0:0xa4] = [SPECIAL] * 4  # mov with a moffs of the address size
+    t[0xa8], t[0xa9] = 1, IMMZ
+    t[0xb0:0xb8] = [1] * 8
+    t[0xb8:0xc0] = [IMMZ] * 8
+    t[0xc0], t[0xc1], t[0xc2] = MODRM | 1, MODRM | 1, 2
+    t[0xc4], t[0xc5] = SPECIAL, SPECIAL  # les/lds, or a VEX prefix
+    t[0xc6], t[0xc7], t[0xc8], t[0xca], t[0xcd] = MODRM | 1, MODRM | IMMZ, 3, 2, 1
+    t[0xd0:0xd4] = [MODRM] * 4
+    t[0xd4] = t[0xd5] = 1
+    t[0xd8:0xe0] = [MODRM] * 8  # x87
+    t[0xe0:0xe8] = [1] * 8  # loop/jcxz/in/out
+    t[0xe8] = t[0xe9] = IMMZ
+    t[0xea], t[0xeb] = SPECIAL, 1
+    t[0xf6] = t[0xf7] = SPECIAL  # test has an immediate, the rest of the group does not
+    t[0xfe] = t[0xff] = MODRM
+    return t
+
+
+def build_two_byte_table():
+    t = [MODRM] * 256
+    for op in [0x04, 0x0a, 0x0c, 0x24, 0x25, 0x26, 0x27, 0x36, 0x39, 0x3b, 0x3c, 0x3d, 0x3e, 0x3f, 0x7a, 0x7b, 0xa6,
+               0xa7]:
+        t[op] = INVALID
+    for op in [0x05, 0x06, 0x07, 0x08, 0x09, 0x0b, 0x0e, 0x77, 0xa0, 0xa1, 0xa2, 0xa8, 0xa9, 0xaa]:
+        t[op] = 0
+    t[0x30:0x36] = [0] * 6  # wrmsr, rdtsc, rdmsr, rdpmc, sysenter, sysexit
+    t[0x37] = 0
+    t[0x20:0x24] = [1] * 4  # mov to/from control and debug registers always use a register operand
+    t[0x0f] = MODRM | 1  # 3DNow!
+    t[0x38] = SPECIAL  # three-byte opcodes, ModRM
+    t[0x3a] = SPECIAL  # three-byte opcodes, ModRM and imm8
+    t[0x70:0x74] = [MODRM | 1] * 4
+    t[0x80:0x90] = [IMMZ] * 16  # jcc rel32
+    for op in [0xa4, 0xac, 0xba, 0xc2, 0xc4, 0xc5, 0xc6]:
+        t[op] = MODRM | 1
+    t[0xc8:0xd0] = [0] * 8  # bswap
+    return t
+
+
+def build_modrm_table(address16):
+    """Return the number of bytes after the ModRM byte (SIB and displacement) for each ModRM value.
+
+    With 32-bit addressing, a SIB byte with base 5 and mod 0 adds 4 bytes more, which decode() checks."""
+    t = []
+    for modrm in xrange(256):
+        mod, rm = modrm >> 6, modrm & 7
+        if mod == 3:
+            t.append(0)
+        elif address16:
+            t.append([2 if rm == 6 else 0, 1, 2][mod])
+        else:
+            t.append((rm == 4) + [4 if rm == 5 else 0, 1, 4][mod])
+    return t
+
+
+ONE_BYTE = build_one_byte_table()
+TWO_BYTE = build_two_byte_table()
+MODRM32 = build_modrm_table(False)
+MODRM16 = build_modrm_table(True)
+
+
+def build_fast_table():
+    """Return the length of every instruction decided by its first two bytes, 0 when decode() has to look further.
+
+    This covers instructions without prefixes or escapes whose second byte is a ModRM byte or part of the immediate,
+    which is most of the code emitted by compilers."""
+    t = array.array('B', [0] * 65536)
+    for op in xrange(256):
+        info = ONE_BYTE[op]
+        if info & (PREFIX | ESCAPE | INVALID):
+            continue
+        if op in (0xf6, 0xf7):
+            for modrm in xrange(256):
+                if modrm & 0xc7 != 0x04:
+                    imm = (1 if op == 0xf6 else 4) if (modrm >> 3) & 7 < 2 else 0
+                    t[op << 8 | modrm] = 2 + MODRM32[modrm] + imm
+            continue
+        if info & SPECIAL:
+            continue
+        length = 1 + (info & 7) + (4 if info & IMMZ else 0)
+        if info & MODRM:
+            for modrm in xrange(256):
+                if modrm & 0xc7 != 0x04:  # SIB with mod 0, the length depends on the base
+                    t[op << 8 | modrm] = length + 1 + MODRM32[modrm]
+        else:
+            t[op << 8:(op + 1) << 8] = array.array('B', [length] * 256)
+    return t
+
+
+# a list, indexing it is faster than indexing an array
+FAST = build_fast_table().tolist()
+
+
+def decode(code, pos):
+    """Return the length of the instruction at pos in code (a bytearray padded with MAX_LENGTH bytes), 0 if invalid."""
+
+    start = pos
+    opsize, modrm_table = 4, MODRM32
+    op = code[pos]
+    info = ONE_BYTE[op]
+    while info & PREFIX:
+        if op == 0x66:
+            opsize = 2
+        elif op == 0x67:
+            modrm_table = MODRM16
+        pos += 1
+        op = code[pos]
+        info = ONE_BYTE[op]
+        if pos - start >= MAX_LENGTH:
+            return 0
+    pos += 1
+
+    if info & ESCAPE:
+        op = code[pos]
+        pos += 1
+        info = TWO_BYTE[op]
+        if op == 0x38:
+            info, pos = MODRM, pos + 1
+        elif op == 0x3a:
+            info, pos = MODRM | 1, pos + 1
+    elif info & SPECIAL:
+        if op == 0x9a or op == 0xea:
+            info = opsize + 2
+        elif op <= 0xa3:
+            info = 2 if modrm_table is MODRM16 else 4
+        elif op == 0xc4 or op == 0xc5:
+            if code[pos] < 0xc0:
+                info = MODRM  # les/lds
+            else:
+                # VEX: the opcode map is in the prefix, 0f 3a opcodes have an imm8
+                if op == 0xc5:
+                    escape, pos = 1, pos + 1
+                else:
+                    escape, pos = code[pos] & 0x1f, pos + 2
+                op = code[pos]
+                pos += 1
+                if escape == 1:
+                    info = TWO_BYTE[op]
+                elif escape == 2:
+                    info = MODRM
+                elif escape == 3:
+                    info = MODRM | 1
+                else:
+                    return 0
+        else:
+            # f6/f7, only test (/0 and /1) has an immediate
+            info = MODRM | ((1 if op == 0xf6 else opsize) if (code[pos] >> 3) & 7 < 2 else 0)
+
+    if info & INVALID:
+        return 0
+    if info & MODRM:
+        modrm = code[pos]
+        pos += 1 + modrm_table[modrm]
+        if modrm_table is MODRM32 and modrm & 0xc7 == 0x04 and code[pos - 1] & 7 == 5:
+            pos += 4
+    pos += info & 7
+    if info & IMMZ:
+        pos += opsize
+
+    length = pos - start
+    return length if length <= MAX_LENGTH else 0
+
+
+def sweep(code, seeds, size=None):
+    """Decode code linearly from each seed offset, return the Instructions found.
+
+    Seeds are swept in ascending order. A sweep ends at the end of the code or at an invalid opcode; a sweep starting
+    inside code an earlier one decoded ends as soon as it reaches one of its instructions. Instructions of two sweeps
+    which have not synchronized yet may overlap, the one starting last wins in containing()."""
+
+    size = len(code) if size is None else size
+    code = bytearray(code[:size]) + bytearray(MAX_LENGTH)
+    fast, decode_ = FAST, decode
+    pieces = []
+    frontier, covered = [], 0  # the instructions of the sweep which got furthest, and where it ended
+
+    for seed in sorted(set(seeds)):
+        if not 0 <= seed < size:
+            continue
+        i = bisect.bisect_left(frontier, seed)
+        if seed < covered and i < len(frontier) and frontier[i] == seed:
+            continue
+        starts = []
+        append = starts.append
+        pos = seed
+
+        # until it reaches an instruction of the frontier, or passes its end
+        while pos < covered:
+            n = fast[code[pos] << 8 | code[pos + 1]] or decode_(code, pos)
+            if not n:
+                break
+            append(pos)
+            pos += n
+            i = bisect.bisect_left(frontier, pos, i)
+            if i < len(frontier) and frontier[i] == pos:
+                break
+        else:
+            # the hot loop, nothing decoded ahead
+            while pos < size:
+                n = fast[code[pos] << 8 | code[pos + 1]] or decode_(code, pos)
+                if not n:
+                    break
+                append(pos)
+                pos += n
+
+        if pos > size:  # the last instruction runs past the end of the code
+            pos = starts.pop()
+        if not starts:
+            continue
+        lengths = map(operator.sub, starts[1:], starts[:-1])
+        lengths.append(pos - starts[-1])
+        pieces.append((starts, lengths))
+        if pos > covered:
+            frontier, covered = starts, pos
+
+    if len(pieces) == 1:
+        return Instructions(array.array('I', pieces[0][0]), array.array('B', pieces[0][1]))
+    pairs = sorted([x for starts, lengths in pieces for x in zip(starts, lengths)])
+    return Instructions(array.array('I', [x[0] for x in pairs]), array.array('B', [x[1] for x in pairs]))
+
+
+class Instructions:
+    """The instructions found by a sweep, as two arrays: start offsets (sorted) and lengths."""
+
+    def __init__(self, starts, lengths):
+        self.starts = starts
+        self.lengths = lengths
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __str__(self):
+        return '%d instructions, %d bytes' % (len(self.starts), sum(self.lengths))
+
+    def containing(self, offset):
+        """Return (start, length) of the instruction containing offset, None if no instruction does."""
+        i = bisect.bisect_right(self.starts, offset) - 1
+        if i >= 0 and offset < self.starts[i] + self.lengths[i]:
+            return self.starts[i], self.lengths[i]
+        return None
+
+    def is_start(self, offset):
+        i = bisect.bisect_left(self.starts, offset)
+        return i < len(self.starts) and self.starts[i] == offset
+
+
+if __name__ == '__main__':
+    # push ebp; mov ebp, esp; sub esp, 0x10; mov eax, [ebx+ecx*4+0x100]; mov eax, [0x403000]; test byte [eax], 1;
+    # call rel32; lea eax, [esi*4]; movzx eax, byte [ecx]; pshufd xmm0, xmm1, 0x1b; mov ax, 0x1234; ret
+    code = ('55' '8bec' '83ec10' '8b848b00010000' 'a100304000' 'f60001' 'e800000000' '8d04b500000000' '0fb601'
+            '660f70c11b' '66b83412' 'c3').decode('hex')
+    expected = [1, 2, 3, 7, 5, 3, 5, 7, 3, 5, 4, 1]
+    instructions = sweep(code, [0])
+    print instructions
+    assert list(instructions.lengths) == expected, list(instructions.lengths)
+    assert instructions.containing(5) == (3, 3)
+    assert instructions.containing(len(code)) is None
+
+    # a seed inside the last instruction of an earlier sweep
+    instructions = sweep('558bece800000000'.decode('hex'), [0, 7])
+    assert list(instructions.starts) == [0, 1, 3], list(instructions.starts)